@@ -0,0 +1,107 @@
+"""对比 /comics/ 图片服务各模式的开销。
+
+默认在临时目录里生成一本测试漫画，用 Flask 测试客户端多线程请求页面，
+分别统计 sendfile、x-accel-redirect、x-sendfile 三种模式的吞吐量和每个请求消耗的 Python CPU 时间。
+测试客户端没有 wsgi.file_wrapper，sendfile 模式下文件内容仍由 Python 读出，
+所以结果反映的是"由 Python 发送字节"与"只返回头、交给前端服务器发送"的差别。
+
+也可以用 --url 对已部署的服务(例如 gunicorn + nginx)做端到端压测，页面路径用 --path 指定：
+
+    python bench_serving.py
+    python bench_serving.py --url http://127.0.0.1:8080 --path 123_标题/1.jpg
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+MODES = ("sendfile", "x-accel-redirect", "x-sendfile")
+
+def run_requests(fetch, paths, total, threads):
+    """用 threads 个线程共发出 total 个请求，返回 (耗时, CPU 时间, 响应字节数)"""
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def worker():
+        size = 0
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None: return size
+            size += fetch(paths[i % len(paths)])
+
+    started, cpu_started = time.perf_counter(), time.process_time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        received = list(executor.map(lambda _: worker(), range(threads)))
+    return time.perf_counter() - started, time.process_time() - cpu_started, sum(received)
+
+def bench_in_process(args):
+    """在临时数据目录中加载 run_library，依次切换 file_serving 模式"""
+    workdir = tempfile.mkdtemp(prefix="bench_serving_")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import run_library
+    if os.path.abspath(run_library.DATA_DIR) != os.path.join(workdir, "data"):
+        sys.exit(f"数据目录是 {run_library.DATA_DIR}，为避免写入真实数据，请在没有 /data 目录的环境中运行")
+    run_library.load_data()
+
+    folder = "1_bench"
+    comic_dir = os.path.join(run_library.app_config["download_path"], folder)
+    os.makedirs(comic_dir, exist_ok=True)
+    payload = os.urandom(args.size * 1024)
+    for page in range(1, args.pages + 1):
+        with open(os.path.join(comic_dir, f"{page}.jpg"), 'wb') as f:
+            f.write(payload)
+    run_library.build_library_index()
+    paths = [f"/comics/{folder}/{page}.jpg" for page in range(1, args.pages + 1)]
+
+    local = threading.local()
+    def fetch(path):
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = run_library.app.test_client()
+        response = client.get(path)
+        size = len(response.data)
+        response.close()
+        return size
+
+    print(f"{args.pages} 页 x {args.size} KB，{args.requests} 个请求，{args.threads} 个线程")
+    print(f"{'模式':<18}{'请求/秒':>10}{'CPU 毫秒/请求':>16}{'Python 发送字节':>18}")
+    for mode in MODES:
+        run_library.app_config["file_serving"] = mode
+        fetch(paths[0])  # 预热
+        elapsed, cpu, size = run_requests(fetch, paths, args.requests, args.threads)
+        print(f"{mode:<18}{args.requests / elapsed:>10.0f}{cpu * 1000 / args.requests:>16.3f}{size:>18}")
+
+def bench_url(args):
+    """对已部署的服务压测，file_serving 模式由服务端配置决定"""
+    base = args.url.rstrip('/')
+    paths = [f"/comics/{quote(p)}" for p in args.path]
+
+    def fetch(path):
+        with urllib.request.urlopen(base + path, timeout=30) as response:
+            return len(response.read())
+
+    elapsed, cpu, size = run_requests(fetch, paths, args.requests, args.threads)
+    print(f"{args.requests} 个请求，{args.threads} 个线程: {args.requests / elapsed:.0f} 请求/秒，"
+          f"{size / elapsed / 1024 / 1024:.1f} MB/s")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="对比图片服务模式的开销")
+    parser.add_argument("--pages", type=int, default=50, help="测试漫画的页数")
+    parser.add_argument("--size", type=int, default=300, help="每页大小 (KB)")
+    parser.add_argument("--requests", type=int, default=2000, help="请求总数")
+    parser.add_argument("--threads", type=int, default=8, help="并发线程数")
+    parser.add_argument("--url", help="压测已部署的服务，而不是在本进程内测试")
+    parser.add_argument("--path", action="append", default=[], help="配合 --url 使用的页面路径 (目录/页面)，可重复")
+    args = parser.parse_args()
+    if args.url:
+        if not args.path: parser.error("--url 需要至少一个 --path")
+        bench_url(args)
+    else:
+        bench_in_process(args)
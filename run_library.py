@@ -1,12 +1,38 @@
 import os
+import re
 import json
 import time
 import threading
+import queue
+import random
 import logging
 import shutil
+import hashlib
+import io
+import sqlite3
+import mimetypes
+import struct
+import zipfile
+from urllib.parse import quote, urlsplit
+from email.utils import parsedate_to_datetime
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 import cloudscraper
 from bs4 import BeautifulSoup
-from flask import Flask, jsonify, render_template_string, request, send_from_directory
+from flask import Flask, Response, g, jsonify, redirect, render_template_string, request, send_file
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow 是可选依赖，缺失时封面直接使用原图
+    Image = None
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 fcntl，leader 锁改用 msvcrt
+    fcntl = None
+    import msvcrt
 
 # --- 默认配置 ---
 DEFAULT_CONFIG = {
@@ -16,6 +42,31 @@ DEFAULT_CONFIG = {
     ],
     "download_path": "comics",
     "check_interval_hours": 24,
+    "page_workers": 4,
+    "metadata_workers": 2,
+    "comic_workers": 2,
+    "pipeline_queue_size": 20,
+    "group_workers": 3,
+    "retry_backoff_minutes": 30,
+    "retry_backoff_max_hours": 48,
+    "retry_max_attempts": 8,
+    "metadata_ttl_days": 30,
+    "metadata_refresh_limit": 500,
+    "metadata_batch_size": 50,
+    "job_concurrency": {"metadata": 1, "thumbnails": 1},
+    "rate_limits": {
+        "nhentai.net": {"rate": 1.0, "min_rate": 0.1, "max_rate": 4.0},
+        "i.nhentai.net": {"rate": 4.0, "min_rate": 0.5, "max_rate": 20.0}
+    },
+    "metadata_backend": "sqlite",
+    "storage_format": "folder",
+    "index_rescan_seconds": 300,
+    "shared_state_sync_seconds": 1,
+    "thumbnail_width": 360,
+    "thumbnail_format": "webp",
+    "thumbnail_cache_mb": 512,
+    "file_serving": "sendfile",
+    "file_serving_internal_prefix": "/internal-comics/",
     "proxies": {
         "http": "",
         "https": ""
@@ -31,16 +82,358 @@ else:
 
 CONFIG_FILE = os.path.join(DATA_DIR, "config.json")
 METADATA_FILE = os.path.join(DATA_DIR, "library_metadata.json")
+METADATA_DB_FILE = os.path.join(DATA_DIR, "library_metadata.db")
+THUMBNAIL_DIR = os.path.join(DATA_DIR, "thumbnails")
+SESSION_COOKIE_FILE = os.path.join(DATA_DIR, "session_cookies.json")
+LEADER_LOCK_FILE = os.path.join(DATA_DIR, "leader.lock")
+CONTROL_DB_FILE = os.path.join(DATA_DIR, "control.db")
 app_config = {}
 library_metadata = {}
+metadata_store = None
 DOWNLOAD_LOG_FILE = ""
+CRAWL_JOURNAL_FILE = ""
+WATERMARK_FILE = ""
 HEADERS = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 }
 KNOWN_LANGUAGES = ["chinese", "english", "japanese", "translated"]
-# --- 任务控制 (使用 RLock 修复死锁问题) ---
-downloader_lock = threading.RLock()
-stop_event = threading.Event()
+IMAGE_CHUNK_SIZE = 64 * 1024
+IMAGE_EXTENSIONS = ('.jpg', '.png', '.jpeg', '.webp')
+# 校验修复和重新打包会就地改写页面而 URL 不变，所以页面只缓存较短时间，过期后用 ETag 重新验证
+PAGE_MAX_AGE = 600
+THUMBNAIL_MAX_AGE = 24 * 3600
+# --- 任务控制 ---
+# 所有后台任务都作为 Job 提交给调度器：按优先级排队，每种任务类型有独立的并发上限，
+# 会同时写下载目录、下载日志和失败队列的任务类型互斥(也和自己互斥，不受并发上限影响)。每个任务有自己的取消事件，
+# 任务内部(包括它启动的工作线程)通过 job_cancelled() 检查自己是否被取消。
+
+# 任务类型: (默认优先级, 不能同时运行的任务类型)；优先级数字越小越先执行
+JOB_TYPES = {
+    "retry": (10, ("retry", "crawl", "verify", "archive")),
+    "metadata": (10, ()),
+    "crawl": (20, ("crawl", "retry", "verify", "archive")),
+    "verify": (30, ("verify", "crawl", "retry", "archive")),
+    "archive": (40, ("archive", "crawl", "retry", "verify")),
+    "thumbnails": (40, ())
+}
+JOB_HISTORY_SIZE = 20
+job_context = threading.local()
+
+class StatusNotifier:
+    """状态变化通知：任务状态、进度或失败队列变化时递增版本号，唤醒等待中的状态推送连接"""
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.version = 0
+
+    def notify(self):
+        with self.condition:
+            self.version += 1
+            self.condition.notify_all()
+
+    def wait(self, version, timeout):
+        """等到版本号不同于 version 或超时，返回当前版本号"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+status_notifier = StatusNotifier()
+
+class Job:
+    """一个后台任务及其进度: 已完成/总数、传输字节数和预计剩余时间"""
+    def __init__(self, job_id, job_type, target, args=(), priority=None, name=None):
+        self.id = job_id
+        self.type = job_type
+        self.name = name or job_type
+        self.target = target
+        self.args = args
+        self.priority = JOB_TYPES[job_type][0] if priority is None else priority
+        self.cancel_event = threading.Event()
+        self.state = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.error = None
+        self.done = 0
+        self.total = None
+        self.bytes = 0
+        self.details = {}
+        self.describe = None  # 返回额外状态的回调，例如下载流水线的快照
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        self.cancel_event.set()
+        status_notifier.notify()
+
+    def set_total(self, total):
+        with self.lock: self.total = total
+        status_notifier.notify()
+
+    def add_total(self, n):
+        with self.lock: self.total = (self.total or 0) + n
+        status_notifier.notify()
+
+    def advance(self, n=1):
+        with self.lock: self.done += n
+        status_notifier.notify()
+
+    def add_bytes(self, n):
+        with self.lock: self.bytes += n
+
+    def snapshot(self):
+        now = time.time()
+        elapsed = (self.finished_at or now) - self.started_at if self.started_at else 0
+        eta = None
+        if self.state == "running" and self.total and self.done and elapsed > 0:
+            eta = round((self.total - self.done) / (self.done / elapsed), 1)
+        snapshot = {
+            "id": self.id, "type": self.type, "name": self.name, "priority": self.priority,
+            "state": "cancelling" if self.state == "running" and self.cancel_event.is_set() else self.state,
+            "done": self.done, "total": self.total, "bytes": self.bytes,
+            "rate": round(self.done / elapsed, 2) if elapsed > 0 else 0.0,
+            "bytes_per_second": round(self.bytes / elapsed) if elapsed > 0 else 0,
+            "eta_seconds": eta, "elapsed_seconds": round(elapsed, 1),
+            "created_at": self.created_at, "started_at": self.started_at, "finished_at": self.finished_at,
+            "error": self.error, "details": dict(self.details)
+        }
+        if self.describe and self.state == "running":
+            try: snapshot.update(self.describe())
+            except Exception: pass
+        return snapshot
+
+def current_job():
+    return getattr(job_context, "job", None)
+
+def job_cancelled():
+    """当前线程所属的任务是否已被取消；不在任务中时始终为 False"""
+    job = current_job()
+    return job is not None and job.cancel_event.is_set()
+
+def job_wait(timeout):
+    """等待 timeout 秒，期间当前任务被取消时提前返回 True"""
+    job = current_job()
+    if job is None:
+        time.sleep(timeout); return False
+    return job.cancel_event.wait(timeout)
+
+def bind_job(fn):
+    """让任务启动的工作线程也归属于当前任务，以便响应取消和汇报进度"""
+    job = current_job()
+    def run_in_job(*args, **kwargs):
+        previous = current_job()
+        job_context.job = job
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            job_context.job = previous
+    return run_in_job
+
+def add_job_bytes(n):
+    job = current_job()
+    if job is not None: job.add_bytes(n)
+
+class JobScheduler:
+    """任务队列：有空闲名额且没有互斥任务在运行时，按优先级启动排队中的任务"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = []
+        self.running = {}
+        self.history = []
+        self.next_id = 1
+
+    def concurrency(self, job_type):
+        return max(1, int(app_config.get("job_concurrency", {}).get(job_type, 1)))
+
+    def submit(self, job_type, target, args=(), priority=None, name=None):
+        """提交任务，返回 (job, 是否新建)；同类型同参数的任务已在排队或运行(且没有被取消)时直接返回该任务"""
+        with self.lock:
+            for job in self.queue + list(self.running.values()):
+                if job.type == job_type and job.args == args and not job.cancel_event.is_set(): return job, False
+            job = Job(self.next_id, job_type, target, args, priority, name)
+            self.next_id += 1
+            self.queue.append(job)
+            self.queue.sort(key=lambda j: (j.priority, j.id))
+            self._dispatch_locked()
+        status_notifier.notify()
+        return job, True
+
+    def run_when_idle(self, job_types, fn):
+        """没有 job_types 中的任务在运行或排队时执行 fn，执行期间不会启动新任务。
+        返回 (是否执行, fn 的返回值)"""
+        with self.lock:
+            if any(job.type in job_types for job in self.queue + list(self.running.values())): return False, None
+            return True, fn()
+
+    def _can_start(self, job):
+        running_types = [j.type for j in self.running.values()]
+        if running_types.count(job.type) >= self.concurrency(job.type): return False
+        return not any(t in running_types for t in JOB_TYPES[job.type][1])
+
+    def _dispatch_locked(self):
+        for job in list(self.queue):
+            if not self._can_start(job): continue
+            self.queue.remove(job)
+            job.state = "running"
+            job.started_at = time.time()
+            self.running[job.id] = job
+            threading.Thread(target=self._run, args=(job,), name=f"job-{job.type}-{job.id}", daemon=True).start()
+
+    def _run(self, job):
+        job_context.job = job
+        logging.info(f"任务 #{job.id} ({job.name}) 开始运行。")
+        try:
+            job.target(job, *job.args)
+            job.state = "cancelled" if job.cancel_event.is_set() else "done"
+        except Exception as e:
+            job.state, job.error = "failed", str(e)
+            logging.exception(f"任务 #{job.id} ({job.name}) 出错: {e}")
+        finally:
+            job.finished_at = time.time()
+            job_context.job = None
+            logging.info(f"任务 #{job.id} ({job.name}) 结束，状态: {job.state}")
+            with self.lock:
+                self.running.pop(job.id, None)
+                self._finish_locked(job)
+                self._dispatch_locked()
+            status_notifier.notify()
+
+    def _finish_locked(self, job):
+        self.history.append(job)
+        del self.history[:-JOB_HISTORY_SIZE]
+
+    def cancel(self, job_id):
+        """取消任务：排队中的直接移出队列，运行中的在安全点停止。找不到或已结束时返回 False"""
+        with self.lock:
+            queued = next((job for job in self.queue if job.id == job_id), None)
+            if queued is not None:
+                self.queue.remove(queued)
+                queued.state, queued.finished_at = "cancelled", time.time()
+                self._finish_locked(queued)
+            running = self.running.get(job_id)
+        if running is not None:
+            running.cancel()
+        elif queued is not None:
+            status_notifier.notify()
+        return running is not None or queued is not None
+
+    def jobs(self, job_types=None, active_only=False):
+        with self.lock:
+            jobs = list(self.running.values()) + list(self.queue)
+            if not active_only: jobs += list(reversed(self.history))
+        return [job for job in jobs if job_types is None or job.type in job_types]
+
+    def snapshot(self):
+        return [job.snapshot() for job in self.jobs()]
+
+job_scheduler = JobScheduler()
+
+# --- 运行指标 ---
+# /metrics 以 Prometheus 文本格式输出。只实现这里用到的计数器、直方图和按需计算的仪表，
+# 不依赖 prometheus_client。每秒页数、每秒漫画数等速率由 Prometheus 对计数器取 rate() 得到。
+# 多进程部署时每个样本带 worker 标签，各进程把自己的指标发布到控制库，任一进程都能返回全部进程的指标。
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+metrics_registry = []
+metrics_worker_labels = []
+
+def format_labels(names, values, extra=None):
+    pairs = metrics_worker_labels + list(zip(names, values)) + ([extra] if extra else [])
+    if not pairs: return ""
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def collect(self):
+        with self.lock: values = dict(self.values)
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in sorted(values.items())]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # 标签 -> [各桶计数, 总和, 总数]
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.setdefault(key, [[0] * len(self.buckets), [0.0, 0]])
+            if index < len(self.buckets): counts[index] += 1
+            total[0] += value
+            total[1] += 1
+
+    def collect(self):
+        with self.lock:
+            values = {key: ([*counts], [*total]) for key, (counts, total) in self.values.items()}
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, (counts, (value_sum, count)) in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labels, key, ('le', '+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {value_sum}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, key)} {count}")
+        return lines
+
+class GaugeCallback:
+    """抓取时才计算的仪表，callback 返回 {标签值元组: 数值}"""
+    def __init__(self, name, help_text, labels, callback):
+        self.name, self.help_text, self.labels, self.callback = name, help_text, labels, callback
+        metrics_registry.append(self)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        lines += [f"{self.name}{format_labels(self.labels, key)} {value}" for key, value in sorted(self.callback().items())]
+        return lines
+
+@contextmanager
+def observe_duration(histogram, **labels):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+def job_queue_depth():
+    depth = {}
+    for job in job_scheduler.jobs(active_only=True):
+        key = (job.type, "queued" if job.state == "queued" else "running")
+        depth[key] = depth.get(key, 0) + 1
+    return depth
+
+def pipeline_queue_depth():
+    for job in job_scheduler.jobs(("crawl",), active_only=True):
+        if job.state == "running" and job.describe:
+            return {(name,): n for name, n in job.describe()["pipeline"]["queues"].items()}
+    return {}
+
+HTTP_REQUEST_SECONDS = Histogram("hcomic_http_request_duration_seconds", "对外 HTTP 请求耗时(到收到响应头为止)", ("host", "kind"))
+HTTP_REQUESTS = Counter("hcomic_http_requests_total", "对外 HTTP 请求数", ("host", "kind", "status"))
+HTTP_THROTTLED = Counter("hcomic_http_throttled_total", "被限流(429/503)的请求数", ("host", "status"))
+RATE_LIMIT_WAIT_SECONDS = Counter("hcomic_rate_limit_wait_seconds_total", "等待限速令牌的总时间", ("host",))
+RETRIES = Counter("hcomic_retries_total", "重试次数", ("kind",))
+RETRY_SLEEP_SECONDS = Counter("hcomic_retry_sleep_seconds_total", "重试前退避等待的总时间", ("kind",))
+DOWNLOADED_BYTES = Counter("hcomic_downloaded_bytes_total", "下载的图片字节数")
+PAGES_DOWNLOADED = Counter("hcomic_pages_downloaded_total", "下载完成的页面数")
+COMICS_PROCESSED = Counter("hcomic_comics_total", "处理完的漫画数", ("result",))
+PARSE_SECONDS = Histogram("hcomic_parse_duration_seconds", "HTML 解析耗时", ("kind",))
+METADATA_WRITE_SECONDS = Histogram("hcomic_metadata_write_duration_seconds", "元数据写入存储的耗时", ("op",))
+HANDLER_SECONDS = Histogram("hcomic_http_handler_duration_seconds", "网页服务处理请求的耗时", ("endpoint",))
+GaugeCallback("hcomic_jobs", "排队和运行中的后台任务数", ("type", "state"), job_queue_depth)
+GaugeCallback("hcomic_pipeline_queue_depth", "下载流水线各队列中等待的漫画数", ("queue",), pipeline_queue_depth)
 
 
 # --- 日志配置 ---
@@ -54,7 +447,7 @@ logging.info(f"数据目录设置为: {os.path.abspath(DATA_DIR)}")
 # --- 配置与元数据管理 ---
 def load_data():
     """加载配置和元数据文件"""
-    global app_config, library_metadata, DOWNLOAD_LOG_FILE
+    global app_config, library_metadata, metadata_store, DOWNLOAD_LOG_FILE, CRAWL_JOURNAL_FILE, WATERMARK_FILE
 
     os.makedirs(DATA_DIR, exist_ok=True)
 
@@ -66,12 +459,12 @@ def load_data():
     else:
         with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
             app_config = json.load(f)
+    shared_state["config_mtime"] = os.stat(CONFIG_FILE).st_mtime_ns
 
-    if not os.path.exists(METADATA_FILE):
-        library_metadata = {}
-    else:
-        with open(METADATA_FILE, 'r', encoding='utf-8') as f:
-            library_metadata = json.load(f)
+    if metadata_store is not None:
+        metadata_store.close()
+    metadata_store = open_metadata_store(app_config.get("metadata_backend", "sqlite"))
+    library_metadata = metadata_store.load()
 
     download_path = app_config.get("download_path", "comics")
     if not os.path.isabs(download_path):
@@ -79,18 +472,1056 @@ def load_data():
     app_config["download_path"] = download_path
 
     DOWNLOAD_LOG_FILE = os.path.join(download_path, "download_log.json")
+    CRAWL_JOURNAL_FILE = os.path.join(download_path, "crawl_journal.jsonl")
+    WATERMARK_FILE = os.path.join(download_path, "crawl_watermarks.json")
     os.makedirs(download_path, exist_ok=True)
+    build_library_index()
+    rebuild_search_index()
+    with rate_limiters_lock:
+        rate_limiters.clear()  # 限速配置可能已修改
 
 def save_config():
     """保存配置"""
     with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
         json.dump(app_config, f, indent=4)
 
-def save_metadata():
-    """保存元数据"""
-    with downloader_lock:
-        with open(METADATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(library_metadata, f, indent=4)
+def save_comic_metadata(comic_id_str):
+    """只保存单本漫画的元数据"""
+    with observe_duration(METADATA_WRITE_SECONDS, op="upsert"):
+        metadata_store.upsert_comic(comic_id_str, library_metadata.get(comic_id_str, {}))
+    update_search_doc(comic_id_str)
+
+def save_comics_metadata(comic_id_strs):
+    """批量保存多本漫画的元数据，在一个事务中提交"""
+    with observe_duration(METADATA_WRITE_SECONDS, op="upsert_batch"):
+        metadata_store.upsert_comics({cid: library_metadata.get(cid, {}) for cid in comic_id_strs})
+    for comic_id_str in comic_id_strs: update_search_doc(comic_id_str)
+
+def delete_comic_metadata(comic_id_str):
+    """从内存和存储中删除单本漫画的元数据"""
+    library_metadata.pop(comic_id_str, None)
+    with observe_duration(METADATA_WRITE_SECONDS, op="delete"):
+        metadata_store.delete_comic(comic_id_str)
+    search_index.remove(comic_id_str)
+
+def save_failed_ids():
+    """只保存失败重试队列"""
+    with failed_ids_lock:
+        failed_ids = dict(library_metadata.get('failed_ids', {}))
+    with observe_duration(METADATA_WRITE_SECONDS, op="failed_ids"):
+        metadata_store.save_failed_ids(failed_ids)
+
+def set_comic_favorite(comic_id_str, favorite):
+    """只更新收藏状态，不会用本进程的标题、标签覆盖其他进程刚写入的内容"""
+    library_metadata.setdefault(comic_id_str, {})['favorite'] = favorite
+    with observe_duration(METADATA_WRITE_SECONDS, op="favorite"):
+        metadata_store.set_favorite(comic_id_str, favorite)
+
+# --- 多进程共享状态同步 ---
+# 多进程部署时每个工作进程都持有一份内存副本。其他进程写入元数据存储或配置文件后，
+# 后台线程定期调用 sync_shared_state 把变化合并进来；单进程运行时这里什么也不做。
+shared_state = {"config_mtime": None}
+shared_state_lock = threading.Lock()
+
+def sync_shared_state():
+    """应用其他进程写入的配置和元数据变化；没有变化时只需一次 stat 和一次 PRAGMA 查询"""
+    with shared_state_lock:
+        try:
+            config_mtime = os.stat(CONFIG_FILE).st_mtime_ns
+        except FileNotFoundError:
+            config_mtime = None
+        if config_mtime != shared_state["config_mtime"]:
+            logging.info("配置文件已被其他进程修改，重新加载配置和元数据。")
+            load_data(); return
+        changes = metadata_store.changes()
+        if not changes: return
+        for comic_id_str in changes["deleted"]:
+            library_metadata.pop(comic_id_str, None)
+            search_index.remove(comic_id_str)
+        for comic_id_str, entry in changes["comics"].items():
+            library_metadata[comic_id_str] = entry
+            update_search_doc(comic_id_str)
+        if changes["failed_ids"] is not None:
+            with failed_ids_lock:
+                library_metadata['failed_ids'] = changes["failed_ids"]
+            status_notifier.notify()
+        # 只重新索引其他进程改动过的目录；变化记录已被清理、无法得知改了哪些目录时才整体重扫
+        if changes["library_folders"] is None: rescan_library_index()
+        for folder in changes["library_folders"] or ():
+            index_comic_folder(folder)
+
+def shared_state_watcher():
+    """后台定期同步其他进程写入的变化"""
+    while True:
+        time.sleep(app_config.get("shared_state_sync_seconds", 1))
+        try:
+            sync_shared_state()
+        except Exception as e:
+            logging.error(f"同步其他进程的元数据失败: {e}")
+
+# --- 失败重试队列 ---
+# library_metadata['failed_ids'] 是 {ID字符串: 记录}，记录失败原因、尝试次数、下次可重试的时间
+# 以及是否已确认失效。画廊已删除(404/410)或失败次数达到上限的漫画标记为 dead，不再重试。
+failed_ids_lock = threading.Lock()
+failure_notes = {}  # 正在处理的漫画最近一次失败的原因，由 record_failure 取走
+
+def normalize_failed_ids(value):
+    """兼容旧版只保存 ID 列表的失败记录"""
+    if isinstance(value, dict): return {str(k): v for k, v in value.items()}
+    now = time.time()
+    return {str(cid): {"reason": "旧版失败记录", "attempts": 1, "next_retry": now, "dead": False, "last_failed": now}
+            for cid in value or []}
+
+def note_failure(comic_id, reason, dead=False):
+    """在失败发生处记下原因，dead 表示画廊已不存在"""
+    failure_notes[int(comic_id)] = (reason, dead)
+
+def retry_delay(attempts):
+    base = float(app_config.get("retry_backoff_minutes", 30)) * 60
+    cap = float(app_config.get("retry_backoff_max_hours", 48)) * 3600
+    return min(cap, base * 2 ** max(0, attempts - 1))
+
+def record_failure(comic_id, reason=None, dead=False, when=None):
+    """记录一次失败并按尝试次数推迟下次重试；未给出原因时使用处理过程中记下的原因。
+    when 早于已有记录的失败时间时说明已经记过，直接忽略(用于重放检查点)。"""
+    noted_reason, noted_dead = failure_notes.pop(int(comic_id), ("未知错误", False))
+    reason, dead = reason or noted_reason, dead or noted_dead
+    now = when or time.time()
+    with failed_ids_lock:
+        failed = library_metadata.setdefault('failed_ids', {})
+        record = failed.get(str(comic_id))
+        if record and when is not None and record.get("last_failed", 0) >= when: return record
+        attempts = (record["attempts"] if record else 0) + 1
+        if not dead and attempts >= int(app_config.get("retry_max_attempts", 8)):
+            dead, reason = True, f"{reason} (已失败 {attempts} 次，不再重试)"
+        record = {"reason": reason, "attempts": attempts, "next_retry": now + retry_delay(attempts),
+                  "dead": dead, "last_failed": now}
+        failed[str(comic_id)] = record
+    if when is None: COMICS_PROCESSED.inc(result="dead" if dead else "failed")
+    status_notifier.notify()
+    return record
+
+def record_success(comic_id):
+    failure_notes.pop(int(comic_id), None)
+    with failed_ids_lock:
+        removed = library_metadata.get('failed_ids', {}).pop(str(comic_id), None)
+    if removed: status_notifier.notify()
+
+def is_retry_blocked(comic_id, now=None):
+    """已确认失效、或还没到下次重试时间的漫画"""
+    record = library_metadata.get('failed_ids', {}).get(str(comic_id))
+    if not record: return False
+    return record["dead"] or record["next_retry"] > (now or time.time())
+
+def eligible_failed_ids(force=False):
+    """到期可重试的漫画 ID，按到期时间排序；force 时忽略退避时间，但仍跳过已失效的漫画"""
+    now = time.time()
+    with failed_ids_lock:
+        items = list(library_metadata.get('failed_ids', {}).items())
+    items.sort(key=lambda item: item[1]["next_retry"])
+    return [int(cid) for cid, record in items if not record["dead"] and (force or record["next_retry"] <= now)]
+
+def failed_ids_summary():
+    now = time.time()
+    with failed_ids_lock:
+        records = list(library_metadata.get('failed_ids', {}).values())
+    waiting = [r["next_retry"] for r in records if not r["dead"]]
+    return {
+        "retryable": len(waiting),
+        "eligible": sum(1 for t in waiting if t <= now),
+        "dead": len(records) - len(waiting),
+        "next_retry": min(waiting) if waiting else None
+    }
+
+# --- 元数据存储后端 ---
+# library_metadata 始终是内存中的完整副本，存储后端只负责持久化。
+# SQLite (WAL) 后端按行 upsert；JSON 后端作为后备，每次修改都整体重写文件。
+
+class JsonMetadataStore:
+    """library_metadata.json 后备存储。self.data 是文件内容的副本，每次修改按参数更新副本后整体重写文件"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.mtime = None
+        self.data = {}
+
+    def _stat(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _read(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        if 'failed_ids' in metadata: metadata['failed_ids'] = normalize_failed_ids(metadata['failed_ids'])
+        return metadata
+
+    @staticmethod
+    def _copy(metadata):
+        return {k: dict(v) if isinstance(v, dict) else v for k, v in metadata.items()}
+
+    def load(self):
+        """返回文件内容；返回的字典与 self.data 互不共享，调用方可以直接修改"""
+        with self.lock:
+            self.mtime = self._stat()
+            self.data = self._read() if self.mtime is not None else {}
+            return self._copy(self.data)
+
+    def _flush(self):
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.data, f, indent=4)
+        os.replace(tmp_path, self.path)
+        self.mtime = self._stat()
+
+    def upsert_comic(self, comic_id_str, entry):
+        with self.lock:
+            self.data[comic_id_str] = dict(entry)
+            self._flush()
+
+    def upsert_comics(self, entries):
+        with self.lock:
+            self.data.update((comic_id_str, dict(entry)) for comic_id_str, entry in entries.items())
+            self._flush()
+
+    def set_favorite(self, comic_id_str, favorite):
+        with self.lock:
+            self.data.setdefault(comic_id_str, {})['favorite'] = favorite
+            self._flush()
+
+    def delete_comic(self, comic_id_str):
+        with self.lock:
+            self.data.pop(comic_id_str, None)
+            self._flush()
+
+    def save_failed_ids(self, failed_ids):
+        with self.lock:
+            self.data['failed_ids'] = dict(failed_ids)
+            self._flush()
+
+    def touch_library(self, folders):
+        pass
+
+    def changes(self):
+        """文件被其他进程重写过时整体重新读取；JSON 文件无法区分哪些条目变了"""
+        if self._stat() == self.mtime: return None
+        metadata = self.load()
+        failed_ids = metadata.pop('failed_ids', {})
+        return {
+            "comics": {k: v for k, v in metadata.items() if isinstance(v, dict)},
+            "deleted": [k for k in list(library_metadata) if k != 'failed_ids' and k not in metadata],
+            "failed_ids": failed_ids,
+            "library_folders": set()
+        }
+
+    def close(self):
+        pass
+
+class SqliteMetadataStore:
+    """SQLite (WAL) 元数据存储，按行更新标题、标签、收藏和失败重试队列。
+    每次写入分配一个递增的修订号(meta 表的 rev)，写入的行和删除记录都带上修订号，
+    多进程部署时其他进程据此只读取自己上次同步之后的变化。"""
+    COMIC_COLUMNS = ('title', 'tags', 'favorite')
+    FAILED_COLUMNS = (
+        ('reason', 'TEXT'),
+        ('attempts', 'INTEGER NOT NULL DEFAULT 1'),
+        ('next_retry', 'REAL NOT NULL DEFAULT 0'),
+        ('dead', 'INTEGER NOT NULL DEFAULT 0'),
+        ('last_failed', 'REAL')
+    )
+    LIBRARY_CHANGES_KEEP = 1000  # library_changes 表只保留最近这么多个修订号内的记录
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS comics (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                tags TEXT,
+                favorite INTEGER,
+                extra TEXT
+            );
+            CREATE TABLE IF NOT EXISTS failed_ids (comic_id INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS deleted_comics (id TEXT PRIMARY KEY, rev INTEGER NOT NULL);
+            CREATE TABLE IF NOT EXISTS library_changes (rev INTEGER NOT NULL, folder TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS library_changes_rev ON library_changes (rev);
+        """)
+        # 旧版数据库的 failed_ids 表只有 ID 一列，comics 表没有修订号
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(failed_ids)")}
+        for name, declaration in self.FAILED_COLUMNS:
+            if name not in columns:
+                self.conn.execute(f"ALTER TABLE failed_ids ADD COLUMN {name} {declaration}")
+        if 'rev' not in {row[1] for row in self.conn.execute("PRAGMA table_info(comics)")}:
+            self.conn.execute("ALTER TABLE comics ADD COLUMN rev INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS comics_rev ON comics (rev)")
+        self.synced_rev = 0      # 内存副本已包含的修订号
+        self.own_revs = set()    # 本进程在 synced_rev 之后写入的修订号，同步时不重复应用失败队列和索引变化
+        self.data_version = None
+
+    def _comic_row(self, comic_id_str, entry):
+        extra = {k: v for k, v in entry.items() if k not in self.COMIC_COLUMNS}
+        tags = entry.get('tags')
+        favorite = entry.get('favorite')
+        return (
+            comic_id_str,
+            entry.get('title'),
+            json.dumps(tags, ensure_ascii=False) if tags is not None else None,
+            int(favorite) if favorite is not None else None,
+            json.dumps(extra, ensure_ascii=False) if extra else None
+        )
+
+    @staticmethod
+    def _comic_entry(title, tags, favorite, extra):
+        entry = json.loads(extra) if extra else {}
+        if title is not None: entry['title'] = title
+        if tags is not None: entry['tags'] = json.loads(tags)
+        if favorite is not None: entry['favorite'] = bool(favorite)
+        return entry
+
+    def _meta_int(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def _set_meta(self, key, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def _write(self, apply):
+        """在一个写事务中分配新的修订号并执行 apply(rev)"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rev = self._meta_int('rev') + 1
+                self._set_meta('rev', rev)
+                apply(rev)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+            if rev == self.synced_rev + 1 and not self.own_revs: self.synced_rev = rev
+            else: self.own_revs.add(rev)
+
+    def _upsert_rows(self, rows, rev):
+        # 收藏状态只由 set_favorite 修改，避免其他进程内存中过时的副本把它覆盖回去
+        self.conn.executemany("""
+            INSERT INTO comics (id, title, tags, favorite, extra, rev) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                title=excluded.title, tags=excluded.tags, extra=excluded.extra, rev=excluded.rev
+        """, [row + (rev,) for row in rows])
+
+    def _load_failed_ids(self):
+        failed_ids = {}
+        for comic_id, reason, attempts, next_retry, dead, last_failed in self.conn.execute(
+                "SELECT comic_id, reason, attempts, next_retry, dead, last_failed FROM failed_ids"):
+            failed_ids[str(comic_id)] = {"reason": reason or "旧版失败记录", "attempts": attempts,
+                                         "next_retry": next_retry, "dead": bool(dead), "last_failed": last_failed or 0}
+        return failed_ids
+
+    def load(self):
+        metadata = {}
+        with self.lock:
+            self.data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            self.conn.execute("BEGIN")
+            try:
+                for comic_id_str, title, tags, favorite, extra in self.conn.execute(
+                        "SELECT id, title, tags, favorite, extra FROM comics"):
+                    metadata[comic_id_str] = self._comic_entry(title, tags, favorite, extra)
+                failed_ids = self._load_failed_ids()
+                self.synced_rev, self.own_revs = self._meta_int('rev'), set()
+            finally:
+                self.conn.execute("COMMIT")
+        if failed_ids: metadata['failed_ids'] = failed_ids
+        return metadata
+
+    def changes(self):
+        """读取其他进程在上次同步之后写入的变化；没有其他连接提交过时只需一次 PRAGMA 查询"""
+        with self.lock:
+            data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self.data_version: return None
+            self.data_version = data_version
+            self.conn.execute("BEGIN")
+            try:
+                rev, since = self._meta_int('rev'), self.synced_rev
+                if rev == since: return None
+                # 本进程写入的行也重新读取：行上可能合并了其他进程单独写入的收藏状态
+                comics = {comic_id_str: self._comic_entry(title, tags, favorite, extra)
+                          for comic_id_str, title, tags, favorite, extra in self.conn.execute(
+                              "SELECT id, title, tags, favorite, extra FROM comics WHERE rev > ?", (since,))}
+                deleted = [row[0] for row in self.conn.execute("SELECT id FROM deleted_comics WHERE rev > ?", (since,))]
+                failed_rev = self._meta_int('failed_rev')
+                failed_ids = self._load_failed_ids() if failed_rev > since and failed_rev not in self.own_revs else None
+                # 同步点早于已清理的变化记录时返回 None，由调用方整体重扫
+                if self._meta_int('library_rev') <= since: library_folders = set()
+                elif self._meta_int('library_pruned_rev') > since: library_folders = None
+                else:
+                    library_folders = {folder for change_rev, folder in self.conn.execute(
+                        "SELECT rev, folder FROM library_changes WHERE rev > ?", (since,))
+                        if change_rev not in self.own_revs}
+            finally:
+                self.conn.execute("COMMIT")
+            self.synced_rev = rev
+            self.own_revs = {r for r in self.own_revs if r > rev}
+        return {"comics": comics, "deleted": deleted, "failed_ids": failed_ids, "library_folders": library_folders}
+
+    def save_all(self, metadata):
+        rows = [self._comic_row(k, v) for k, v in list(metadata.items()) if k != 'failed_ids' and isinstance(v, dict)]
+        def apply(rev):
+            self._upsert_rows(rows, rev)
+            self._replace_failed_ids(metadata.get('failed_ids', {}), rev)
+        self._write(apply)
+
+    def upsert_comic(self, comic_id_str, entry):
+        self._write(lambda rev: self._upsert_rows([self._comic_row(comic_id_str, entry)], rev))
+
+    def upsert_comics(self, entries):
+        rows = [self._comic_row(k, v) for k, v in entries.items()]
+        self._write(lambda rev: self._upsert_rows(rows, rev))
+
+    def set_favorite(self, comic_id_str, favorite):
+        def apply(rev):
+            self.conn.execute("""
+                INSERT INTO comics (id, favorite, rev) VALUES (?, ?, ?)
+                ON CONFLICT(id) DO UPDATE SET favorite=excluded.favorite, rev=excluded.rev
+            """, (comic_id_str, int(favorite), rev))
+        self._write(apply)
+
+    def delete_comic(self, comic_id_str):
+        def apply(rev):
+            self.conn.execute("DELETE FROM comics WHERE id = ?", (comic_id_str,))
+            self.conn.execute("INSERT OR REPLACE INTO deleted_comics (id, rev) VALUES (?, ?)", (comic_id_str, rev))
+        self._write(apply)
+
+    def _replace_failed_ids(self, failed_ids, rev):
+        failed_ids = normalize_failed_ids(failed_ids)
+        wanted = {int(cid) for cid in failed_ids}
+        existing = {row[0] for row in self.conn.execute("SELECT comic_id FROM failed_ids")}
+        self.conn.executemany("DELETE FROM failed_ids WHERE comic_id = ?", [(cid,) for cid in existing - wanted])
+        self.conn.executemany("""
+            INSERT INTO failed_ids (comic_id, reason, attempts, next_retry, dead, last_failed) VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(comic_id) DO UPDATE SET
+                reason=excluded.reason, attempts=excluded.attempts, next_retry=excluded.next_retry,
+                dead=excluded.dead, last_failed=excluded.last_failed
+        """, [(int(cid), r["reason"], r["attempts"], r["next_retry"], int(r["dead"]), r.get("last_failed"))
+              for cid, r in failed_ids.items()])
+        self._set_meta('failed_rev', rev)
+
+    def save_failed_ids(self, failed_ids):
+        self._write(lambda rev: self._replace_failed_ids(failed_ids, rev))
+
+    def touch_library(self, folders):
+        """记录下载目录中有变化的漫画目录，其他进程同步时只重新索引这些目录"""
+        def apply(rev):
+            self.conn.executemany("INSERT INTO library_changes (rev, folder) VALUES (?, ?)",
+                                  [(rev, folder) for folder in folders])
+            self._set_meta('library_rev', rev)
+            pruned = rev - self.LIBRARY_CHANGES_KEEP
+            if pruned > self._meta_int('library_pruned_rev'):
+                self.conn.execute("DELETE FROM library_changes WHERE rev <= ?", (pruned,))
+                self._set_meta('library_pruned_rev', pruned)
+        self._write(apply)
+
+    def migrate_from_json(self, json_path):
+        """首次启用 SQLite 时，把已有的 library_metadata.json 一次性导入"""
+        with self.lock:
+            done = self.conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done or not os.path.exists(json_path): return
+        with open(json_path, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+        self.save_all(metadata)
+        with self.lock:
+            self._set_meta('json_migrated', int(time.time()))
+        logging.info(f"已将 {json_path} 中的 {len(metadata)} 条元数据迁移到 SQLite。")
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+def open_metadata_store(backend):
+    """按配置打开元数据存储，SQLite 不可用时回退到 JSON 文件"""
+    if backend == "sqlite":
+        try:
+            store = SqliteMetadataStore(METADATA_DB_FILE)
+            store.migrate_from_json(METADATA_FILE)
+            return store
+        except (sqlite3.Error, OSError, ValueError) as e:
+            logging.error(f"打开 SQLite 元数据库失败，回退到 JSON 文件: {e}")
+    return JsonMetadataStore(METADATA_FILE)
+
+# --- 本地漫画库索引 ---
+# 启动时扫描一次下载目录，之后由下载、删除接口增量更新，
+# 后台线程按目录 mtime 定期重扫以发现在程序外部增删的文件夹。
+library_index = {}
+library_index_lock = threading.Lock()
+library_index_state = {"path": None, "root_mtime": None}
+
+def page_sort_key(filename):
+    return int(os.path.splitext(filename)[0])
+
+def comic_entry(comic_id_str, folder, names, mtime, archive):
+    """由目录或归档中的文件名生成索引条目：只收录以数字命名的图片，按页码排序"""
+    pages = [name for name in names
+             if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS and os.path.splitext(name)[0].isdigit()]
+    pages.sort(key=page_sort_key)
+    cover = None
+    covers = {p.lower(): p for p in pages if os.path.splitext(p)[0] == '1'}
+    for ext in IMAGE_EXTENSIONS:
+        if '1' + ext in covers:
+            cover = covers['1' + ext]; break
+    return {
+        "id": comic_id_str,
+        "folder": folder,
+        "archive": archive,
+        "cover": cover,
+        "pages": pages,
+        "page_count": len(pages),
+        "mtime": mtime
+    }
+
+def scan_comic_folder(download_path, folder):
+    """扫描单个漫画目录或同名的 CBZ 归档(目录优先)，返回索引条目；名字不规范或不存在时返回 None"""
+    if folder.lower().endswith(ARCHIVE_EXTENSION): folder = folder[:-len(ARCHIVE_EXTENSION)]
+    parts = folder.split('_', 1)
+    if len(parts) < 2 or not parts[0].isdigit(): return None
+    comic_dir = os.path.join(download_path, folder)
+    try:
+        mtime = os.stat(comic_dir).st_mtime
+        with os.scandir(comic_dir) as it:
+            names = [entry.name for entry in it if entry.is_file()]
+        return comic_entry(parts[0], folder, names, mtime, False)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    archive_path = comic_dir + ARCHIVE_EXTENSION
+    try:
+        mtime = os.stat(archive_path).st_mtime
+        names = list(archive_index(archive_path))
+    except FileNotFoundError:
+        return None
+    except (OSError, zipfile.BadZipFile) as e:
+        logging.warning(f"无法读取漫画归档 {archive_path}: {e}")
+        return None
+    return comic_entry(parts[0], folder, names, mtime, True)
+
+def list_library_names(download_path):
+    """下载目录中的漫画目录和 CBZ 归档的名字"""
+    with os.scandir(download_path) as it:
+        return {e.name for e in it if e.is_dir() or (e.name.lower().endswith(ARCHIVE_EXTENSION) and e.is_file())}
+
+library_index_collisions = set()
+
+def choose_index_entry(current, entry):
+    """索引按 ID 登记，同一 ID 有多个目录时只登记 mtime 较新的那个，每组冲突只警告一次"""
+    if current is None or current["folder"] == entry["folder"]: return entry
+    newer = (entry["mtime"], entry["folder"]) >= (current["mtime"], current["folder"])
+    winner, loser = (entry, current) if newer else (current, entry)
+    key = (entry["id"], frozenset((current["folder"], entry["folder"])))
+    if key not in library_index_collisions:
+        library_index_collisions.add(key)
+        logging.warning(f"漫画 {entry['id']} 有多个目录: '{winner['folder']}' 和 '{loser['folder']}'，"
+                        f"索引中只使用较新的 '{winner['folder']}'，请手动合并或删除另一个。")
+    return winner
+
+def build_library_index():
+    """全量扫描下载目录，重建漫画库索引"""
+    download_path = app_config.get("download_path")
+    new_index = {}
+    root_mtime = None
+    if download_path and os.path.isdir(download_path):
+        root_mtime = os.stat(download_path).st_mtime
+        for folder in list_library_names(download_path):
+            entry = scan_comic_folder(download_path, folder)
+            if entry: new_index[entry["id"]] = choose_index_entry(new_index.get(entry["id"]), entry)
+    with library_index_lock:
+        library_index.clear()
+        library_index.update(new_index)
+        library_index_state["path"] = download_path
+        library_index_state["root_mtime"] = root_mtime
+    logging.info(f"漫画库索引已建立，共 {len(new_index)} 个目录。")
+
+def index_comic_folder(folder):
+    """增量更新单个漫画目录的索引，返回这个目录的条目(同一 ID 的其他目录较新时不登记)"""
+    download_path = app_config.get("download_path")
+    entry = scan_comic_folder(download_path, folder)
+    with library_index_lock:
+        if entry:
+            current = library_index.get(entry["id"])
+            # 已登记的目录被改名或删除时直接替换
+            if current and not os.path.exists(os.path.join(download_path, comic_disk_name(current))): current = None
+            library_index[entry["id"]] = choose_index_entry(current, entry)
+        else:
+            old = library_index.get(folder.split('_')[0])
+            if old and folder in (old["folder"], comic_disk_name(old)): del library_index[old["id"]]
+    if entry: update_search_doc(entry["id"])
+    return entry
+
+def remove_from_index(comic_id_str, folder=None):
+    """从索引中移除漫画；给出 folder 时只在登记的正是这个目录时移除(同一 ID 可能已换成另一个目录)"""
+    with library_index_lock:
+        entry = library_index.get(comic_id_str)
+        if entry and (folder is None or entry["folder"] == folder): del library_index[comic_id_str]
+
+def publish_library_change(*folders):
+    """下载、修复或删除漫画后通知其他进程重新索引这些目录"""
+    metadata_store.touch_library(folders)
+
+def is_safe_folder_name(comic_folder):
+    """请求中的目录名只能是下载目录下的一层名字：不能含路径分隔符(包括 Windows 的反斜杠)或 '..'"""
+    if not comic_folder or '..' in comic_folder or os.sep in comic_folder: return False
+    return os.altsep is None or os.altsep not in comic_folder
+
+def get_index_entry(comic_folder):
+    """按目录名查找索引条目，索引中没有时回退到扫描磁盘。
+    回退扫描的结果不写入索引，以免请求中的名字覆盖同一 ID 下已登记的目录；不安全的名字直接返回 None"""
+    if not is_safe_folder_name(comic_folder): return None
+    with library_index_lock:
+        entry = library_index.get(comic_folder.split('_')[0])
+    if entry and entry["folder"] == comic_folder: return entry
+    return scan_comic_folder(app_config.get("download_path"), comic_folder)
+
+def rescan_library_index():
+    """根据目录 mtime 增量重扫：发现新增/删除的文件夹，并重扫内容有变化的文件夹"""
+    download_path = app_config.get("download_path")
+    if not download_path or not os.path.isdir(download_path): return
+    if library_index_state["path"] != download_path:
+        build_library_index(); return
+
+    root_mtime = os.stat(download_path).st_mtime
+    with library_index_lock:
+        known = {comic_disk_name(e): e for e in library_index.values()}
+    if root_mtime != library_index_state["root_mtime"]:
+        folders = list_library_names(download_path)
+        for folder in set(known) - folders:
+            remove_from_index(known[folder]["id"], known[folder]["folder"])
+        for folder in folders - set(known):
+            index_comic_folder(folder)
+        library_index_state["root_mtime"] = root_mtime
+    for folder, entry in known.items():
+        try:
+            if os.stat(os.path.join(download_path, folder)).st_mtime != entry["mtime"]:
+                index_comic_folder(folder)
+        except FileNotFoundError:
+            remove_from_index(entry["id"], entry["folder"])
+
+def library_watcher():
+    """后台定期重扫下载目录"""
+    while True:
+        time.sleep(app_config.get("index_rescan_seconds", 300))
+        try:
+            rescan_library_index()
+        except Exception as e:
+            logging.error(f"重扫漫画库索引失败: {e}")
+
+# --- CBZ 归档存储 ---
+# storage_format 为 "cbz" 时，下载完成的漫画打包成不压缩(stored)的 "ID_标题.cbz"，
+# 每本漫画只占一个文件。索引条目的 folder 仍是不带扩展名的名字，archive 标记它存放在归档里。
+# 读取页面时按缓存的中央目录找到页面在归档中的位置，直接读出这一段，不解压、不展开归档。
+ARCHIVE_EXTENSION = ".cbz"
+ARCHIVE_INDEX_CACHE_SIZE = 512
+archive_index_cache = OrderedDict()
+archive_index_lock = threading.Lock()
+
+def comic_disk_name(entry):
+    """索引条目在下载目录中的名字：目录名，或带扩展名的归档文件名"""
+    return entry["folder"] + ARCHIVE_EXTENSION if entry["archive"] else entry["folder"]
+
+def archive_index(path):
+    """归档的中央目录 {文件名: (本地文件头偏移, 长度, 是否未压缩)}，按文件的 mtime 和大小缓存"""
+    st = os.stat(path)
+    key = (st.st_mtime_ns, st.st_size)
+    with archive_index_lock:
+        cached = archive_index_cache.get(path)
+        if cached and cached[0] == key:
+            archive_index_cache.move_to_end(path)
+            return cached[1]
+    with zipfile.ZipFile(path) as zf:
+        index = {info.filename: (info.header_offset, info.file_size, info.compress_type == zipfile.ZIP_STORED)
+                 for info in zf.infolist() if not info.is_dir()}
+    with archive_index_lock:
+        archive_index_cache[path] = (key, index)
+        archive_index_cache.move_to_end(path)
+        while len(archive_index_cache) > ARCHIVE_INDEX_CACHE_SIZE:
+            archive_index_cache.popitem(last=False)
+    return index
+
+def read_archive_member(path, name):
+    """从归档中读出一个文件；归档在两次读取之间被重新打包替换时，丢弃缓存的中央目录重试一次"""
+    try:
+        return read_archive_member_once(path, name)
+    except zipfile.BadZipFile:
+        with archive_index_lock:
+            archive_index_cache.pop(path, None)
+        return read_archive_member_once(path, name)
+
+def read_archive_member_once(path, name):
+    """未压缩的文件跳过本地文件头直接读取，其他的交给 zipfile 解压"""
+    header_offset, size, stored = archive_index(path)[name]
+    if not stored:
+        with zipfile.ZipFile(path) as zf: return zf.read(name)
+    with open(path, 'rb') as f:
+        f.seek(header_offset)
+        header = f.read(zipfile.sizeFileHeader)
+        if len(header) < zipfile.sizeFileHeader or header[:4] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"{name} 的本地文件头已损坏")
+        name_length, extra_length = struct.unpack_from('<HH', header, 26)
+        f.seek(name_length + extra_length, os.SEEK_CUR)
+        data = f.read(size)
+    if len(data) < size: raise zipfile.BadZipFile(f"{name} 的数据不完整")
+    return data
+
+def pack_comic_folder(folder):
+    """把漫画目录中的所有文件(页面、页面清单和其他文件，不含下载中的临时文件)打包成不压缩的 CBZ 归档，
+    写入并校验完成后删除目录，返回新的索引条目。目录中有子目录时不打包，以免删除目录时丢失内容"""
+    comic_dir = os.path.join(app_config.get("download_path"), folder)
+    archive_path = comic_dir + ARCHIVE_EXTENSION
+    with os.scandir(comic_dir) as it:
+        entries = list(it)
+    subdirs = [e.name for e in entries if not e.is_file()]
+    if subdirs: raise OSError(f"目录中有子目录或特殊文件 {subdirs}，不打包")
+    names = [e.name for e in entries if not e.name.endswith(('.part', '.tmp'))]
+    pages = comic_entry(folder.split('_')[0], folder, names, 0, False)["pages"]
+    members = pages + sorted(name for name in names if name not in pages)
+
+    tmp_path = f"{archive_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as f:
+            with zipfile.ZipFile(f, 'w', compression=zipfile.ZIP_STORED) as zf:
+                for name in members: zf.write(os.path.join(comic_dir, name), name)
+            f.flush()
+            os.fsync(f.fileno())
+        with zipfile.ZipFile(tmp_path) as zf:
+            if zf.namelist() != members: raise zipfile.BadZipFile("归档内容与目录不一致")
+        os.replace(tmp_path, archive_path)
+    except BaseException:
+        if os.path.exists(tmp_path): os.remove(tmp_path)
+        raise
+    shutil.rmtree(comic_dir)
+    return index_comic_folder(folder)
+
+def unpack_comic_archive(folder):
+    """把归档解回目录并删除归档(修复损坏的页面时使用)；CRC 校验失败的文件不解出，当作缺失页面重新下载"""
+    comic_dir = os.path.join(app_config.get("download_path"), folder)
+    archive_path = comic_dir + ARCHIVE_EXTENSION
+    os.makedirs(comic_dir, exist_ok=True)
+    with zipfile.ZipFile(archive_path) as zf:
+        for name in zf.namelist():
+            if os.path.basename(name) != name or name in ('.', '..'): continue
+            try:
+                data = zf.read(name)
+            except (zipfile.BadZipFile, OSError) as e:
+                logging.warning(f"  归档 {folder} 中的 {name} 已损坏: {e}")
+                continue
+            with open(os.path.join(comic_dir, name), 'wb') as f:
+                f.write(data)
+    os.remove(archive_path)
+    return index_comic_folder(folder)
+
+def storage_uses_archives():
+    return app_config.get("storage_format", "folder") == "cbz"
+
+# --- 标签/标题倒排索引 ---
+# 键的形式为 "分类:值"：标签按分类存整值(如 "tag:dick girl")，同时把标签和标题
+# 分词后存入 "title:"、"any:" 键。中日韩文字没有空格，按单字切分。
+CJK_CHARS = '\u3040-\u30ff\u3400-\u9fff\uf900-\ufaff\uac00-\ud7af'
+TOKEN_RE = re.compile(f'[{CJK_CHARS}]|[^\\W_{CJK_CHARS}]+')
+QUERY_RE = re.compile(r'(-?)(?:([^\s:"]+):)?(?:"([^"]*)"|(\S+))')
+CATEGORY_ALIASES = {
+    "tags": "tag", "artists": "artist", "groups": "group", "languages": "language",
+    "parodies": "parody", "characters": "character", "categories": "category"
+}
+
+def normalize_category(name):
+    name = name.strip().lower()
+    return CATEGORY_ALIASES.get(name, name)
+
+def tokenize(text):
+    return TOKEN_RE.findall(text.lower())
+
+# 未限定分类的词短于此长度时只精确匹配：很短的前缀(如 "w1")会命中大量键，并集代价接近全库
+SEARCH_MIN_PREFIX = 3
+
+class SearchIndex:
+    """支持 AND/NOT 和 分类:值 语法的内存倒排索引，可按单本漫画增量更新"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.postings = {}
+        self.sorted_keys = []
+        self.doc_keys = {}
+
+    def _doc_keys(self, title, tags):
+        keys = set()
+        for token in tokenize(title):
+            keys.add("title:" + token)
+            keys.add("any:" + token)
+        for category, values in tags.items():
+            category = normalize_category(category)
+            for value in values:
+                value = value.strip().lower()
+                keys.add(f"{category}:{value}")
+                keys.add("any:" + value)
+                for token in tokenize(value):
+                    keys.add("any:" + token)
+        return keys
+
+    def _remove_locked(self, doc_id):
+        for key in self.doc_keys.pop(doc_id, ()):
+            ids = self.postings.get(key)
+            if ids is None: continue
+            ids.discard(doc_id)
+            if not ids:
+                del self.postings[key]
+                pos = bisect_left(self.sorted_keys, key)
+                if pos < len(self.sorted_keys) and self.sorted_keys[pos] == key:
+                    del self.sorted_keys[pos]
+
+    def update(self, doc_id, title, tags):
+        keys = self._doc_keys(title or "", tags or {})
+        with self.lock:
+            self._remove_locked(doc_id)
+            self.doc_keys[doc_id] = keys
+            for key in keys:
+                ids = self.postings.get(key)
+                if ids is None:
+                    self.postings[key] = ids = set()
+                    insort(self.sorted_keys, key)
+                ids.add(doc_id)
+
+    def remove(self, doc_id):
+        with self.lock:
+            self._remove_locked(doc_id)
+
+    def rebuild(self, docs):
+        """docs 为 (doc_id, title, tags) 的可迭代对象"""
+        postings = {}
+        doc_keys = {}
+        for doc_id, title, tags in docs:
+            keys = self._doc_keys(title or "", tags or {})
+            doc_keys[doc_id] = keys
+            for key in keys:
+                postings.setdefault(key, set()).add(doc_id)
+        with self.lock:
+            self.postings = postings
+            self.doc_keys = doc_keys
+            self.sorted_keys = sorted(postings)
+
+    def _prefix_match(self, prefix):
+        """返回所有以 prefix 开头的键对应的文档并集"""
+        result = set()
+        pos = bisect_left(self.sorted_keys, prefix)
+        while pos < len(self.sorted_keys) and self.sorted_keys[pos].startswith(prefix):
+            result |= self.postings[self.sorted_keys[pos]]
+            pos += 1
+        return result
+
+    def _match_term(self, category, value, quoted):
+        """返回匹配单个词的文档集合(可能直接是倒排表本身，调用方不得修改)"""
+        value = value.strip().lower()
+        if not value: return None
+        if category and category != "title":
+            return self.postings.get(f"{normalize_category(category)}:{value}", set())
+        scope = "title:" if category == "title" else "any:"
+        if quoted and scope == "any:" and scope + value in self.postings:
+            return self.postings[scope + value]
+        # 未限定分类的词按分词后逐个前缀匹配，全部命中才算匹配
+        result = None
+        for token in tokenize(value):
+            if len(token) < SEARCH_MIN_PREFIX:
+                matched = self.postings.get(scope + token, set())
+            else:
+                matched = self._prefix_match(scope + token)
+            result = matched if result is None else result & matched
+            if not result: return set()
+        return result if result is not None else set()
+
+    def search(self, query):
+        """返回 (included, excluded)：included 为匹配的文档 ID 集合(已去掉 excluded)，
+        为 None 表示没有包含条件、不按包含过滤；excluded 为需排除的文档 ID 集合。
+        只有排除条件时不复制全部文档，由调用方在遍历时跳过 excluded"""
+        include, exclude = [], []
+        negate_next = False
+        for negate, category, quoted_value, value in QUERY_RE.findall(query):
+            quoted = bool(quoted_value)
+            value = quoted_value if quoted else value
+            if not category and not quoted and value.upper() in ("AND", "NOT"):
+                negate_next = value.upper() == "NOT"
+                continue
+            (exclude if negate or negate_next else include).append((category, value, quoted))
+            negate_next = False
+        with self.lock:
+            included = [self._match_term(*term) for term in include]
+            included = sorted((m for m in included if m is not None), key=len)
+            # 从最小的集合开始求交集，开销只与结果大小相关
+            result = set(included[0]) if included else None
+            for matched in included[1:]:
+                if not result: break
+                result.intersection_update(matched)
+            excluded = set()
+            for term in exclude:
+                matched = self._match_term(*term)
+                if not matched: continue
+                if result is None:
+                    excluded |= matched
+                elif result:
+                    result.difference_update(matched)
+        return result, excluded
+
+search_index = SearchIndex()
+
+def search_doc_fields(comic_id_str):
+    """搜索索引使用的标题和标签：标题缺失时使用目录名中的标题"""
+    comic_metadata = library_metadata.get(comic_id_str, {})
+    title = comic_metadata.get('title')
+    if title is None:
+        with library_index_lock:
+            entry = library_index.get(comic_id_str)
+        title = entry["folder"].split('_', 1)[1] if entry else ""
+    return title, comic_metadata.get('tags', {})
+
+def update_search_doc(comic_id_str):
+    title, tags = search_doc_fields(comic_id_str)
+    search_index.update(comic_id_str, title, tags)
+
+def rebuild_search_index():
+    with library_index_lock:
+        ids = set(library_index)
+    ids.update(k for k, v in library_metadata.items() if k != 'failed_ids' and isinstance(v, dict))
+    search_index.rebuild((cid, *search_doc_fields(cid)) for cid in ids)
+
+# --- 封面缩略图 ---
+# 缩略图按 (源文件路径, 大小, mtime, 宽度, 格式) 的哈希命名，源文件变化后自动生成新文件；
+# 缓存目录超过 thumbnail_cache_mb 时按最近访问时间淘汰。
+# 请求的宽度只取配置宽度和它的 2 倍(高分屏)两档，避免任意 ?w= 生成大量不同尺寸的缓存文件。
+THUMBNAIL_FORMATS = {"webp": ("WEBP", ".webp", "image/webp"), "jpeg": ("JPEG", ".jpg", "image/jpeg")}
+thumbnail_locks = {}
+thumbnail_locks_guard = threading.Lock()
+thumbnail_cache_state = {"size": None}
+thumbnail_cache_lock = threading.Lock()
+thumbnail_evict_lock = threading.Lock()
+
+def thumbnail_settings(width=None):
+    fmt = app_config.get("thumbnail_format", "webp")
+    if fmt not in THUMBNAIL_FORMATS: fmt = "webp"
+    default_width = min(max(int(app_config.get("thumbnail_width", 360)), 64), 1200)
+    allowed = (default_width, min(default_width * 2, 1200))
+    if width: default_width = next((w for w in allowed if w >= width), allowed[-1])
+    return default_width, fmt
+
+def thumbnail_path_for(src_path, width, fmt):
+    st = os.stat(src_path)
+    key = hashlib.sha1(f"{os.path.abspath(src_path)}|{st.st_size}|{st.st_mtime_ns}|{width}|{fmt}".encode('utf-8')).hexdigest()
+    return os.path.join(THUMBNAIL_DIR, key[:2], key + THUMBNAIL_FORMATS[fmt][1])
+
+def cover_source_path(entry):
+    """封面文件的路径；归档中的漫画返回归档本身的路径，缩略图随归档变化而失效"""
+    if entry["archive"]: return os.path.join(app_config.get("download_path"), comic_disk_name(entry))
+    return os.path.join(app_config.get("download_path"), entry["folder"], entry["cover"])
+
+def get_thumbnail(entry, width=None):
+    """返回封面缩略图路径，不存在时生成；没有 Pillow 或生成失败时返回 None"""
+    if Image is None or not entry or not entry["cover"]: return None
+    width, fmt = thumbnail_settings(width)
+    src_path = cover_source_path(entry)
+    try:
+        thumb_path = thumbnail_path_for(src_path, width, fmt)
+    except FileNotFoundError:
+        return None
+    if os.path.exists(thumb_path):
+        try: os.utime(thumb_path)
+        except OSError: pass
+        return thumb_path
+
+    with thumbnail_locks_guard:
+        lock = thumbnail_locks.setdefault(thumb_path, threading.Lock())
+    with lock:
+        try:
+            if not os.path.exists(thumb_path):
+                source = io.BytesIO(read_archive_member(src_path, entry["cover"])) if entry["archive"] else src_path
+                generate_thumbnail(source, thumb_path, width, fmt)
+        except Exception as e:
+            logging.warning(f"生成缩略图失败 {src_path}: {e}")
+            return None
+        finally:
+            with thumbnail_locks_guard:
+                thumbnail_locks.pop(thumb_path, None)
+    return thumb_path
+
+def generate_thumbnail(source, thumb_path, width, fmt):
+    """source 是封面文件路径或已读入内存的封面"""
+    pil_format = THUMBNAIL_FORMATS[fmt][0]
+    os.makedirs(os.path.dirname(thumb_path), exist_ok=True)
+    tmp_path = f"{thumb_path}.{os.getpid()}.tmp"  # 多进程部署时可能有两个进程同时生成
+    with Image.open(source) as img:
+        img.draft('RGB', (width, width * 3))
+        img.thumbnail((width, width * 3))
+        if img.mode not in ('RGB', 'L'): img = img.convert('RGB')
+        img.save(tmp_path, pil_format, quality=80)
+    os.replace(tmp_path, thumb_path)
+    add_thumbnail_cache_size(os.path.getsize(thumb_path))
+
+def add_thumbnail_cache_size(delta):
+    with thumbnail_cache_lock:
+        if thumbnail_cache_state["size"] is None:
+            thumbnail_cache_state["size"] = sum(f[1] for f in list_thumbnail_files())
+        else:
+            thumbnail_cache_state["size"] += delta
+        over_limit = thumbnail_cache_state["size"] > app_config.get("thumbnail_cache_mb", 512) * 1024 * 1024
+    if over_limit: evict_thumbnails()
+
+def list_thumbnail_files():
+    """返回已生成的缩略图的 (路径, 大小, 最近访问时间) 列表"""
+    files = []
+    if not os.path.isdir(THUMBNAIL_DIR): return files
+    for root, _, names in os.walk(THUMBNAIL_DIR):
+        for name in names:
+            if name.endswith('.tmp'): continue  # 正在生成的缩略图
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+                files.append((path, st.st_size, st.st_mtime))
+            except FileNotFoundError:
+                pass
+    return files
+
+def evict_thumbnails():
+    """淘汰最久未访问的缩略图，直到缓存降到上限的 90%；已有线程在淘汰时直接返回"""
+    if not thumbnail_evict_lock.acquire(blocking=False): return
+    try:
+        limit = app_config.get("thumbnail_cache_mb", 512) * 1024 * 1024 * 0.9
+        with thumbnail_cache_lock:
+            counted_before = thumbnail_cache_state["size"] or 0
+        files = sorted(list_thumbnail_files(), key=lambda f: f[2])
+        total = sum(f[1] for f in files)
+        removed = freed = 0
+        for path, size, _ in files:
+            if total - freed <= limit: break
+            try:
+                os.remove(path)
+                freed += size
+                removed += 1
+            except OSError:
+                pass
+        # 以实际扫描到的大小为准，再加上淘汰期间其他线程新生成的缩略图
+        with thumbnail_cache_lock:
+            added_meanwhile = (thumbnail_cache_state["size"] or 0) - counted_before
+            thumbnail_cache_state["size"] = total - freed + max(0, added_meanwhile)
+    finally:
+        thumbnail_evict_lock.release()
+    logging.info(f"缩略图缓存淘汰了 {removed} 个文件。")
+
+def backfill_thumbnails_task(job):
+    """为已有的漫画批量生成缩略图"""
+    if Image is None: return
+    with library_index_lock:
+        entries = list(library_index.values())
+    job.set_total(len(entries))
+    logging.info(f"--- 开始为 {len(entries)} 本漫画补全缩略图 ---")
+    for entry in entries:
+        if job_cancelled(): break
+        get_thumbnail(entry)
+        job.advance()
+    logging.info("--- 缩略图补全完成 ---")
 
 # --- 后端下载器 ---
 
@@ -103,251 +1534,1359 @@ def load_download_log():
 def save_download_log(downloaded_ids):
     download_path = app_config.get("download_path")
     os.makedirs(download_path, exist_ok=True)
-    with open(DOWNLOAD_LOG_FILE, 'w') as f: json.dump(list(downloaded_ids), f, indent=4)
+    # 先写临时文件再替换，检查点日志在此之后会被清空，下载记录不能只写一半
+    tmp_path = DOWNLOAD_LOG_FILE + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(list(downloaded_ids), f, indent=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, DOWNLOAD_LOG_FILE)
+
+class CrawlJournal:
+    """下载任务的追加式检查点日志，每条记录写入后立即 fsync。
+
+    记录类型: start(本次任务的标签组)、done/failed(单本漫画结果，failed 带失败原因)、
+    cursor(某标签组已处理完的搜索页)、group_done(标签组搜索结束)。
+    任务正常结束后合并进 download_log.json 和 failed_ids 并删除日志。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = None
+
+    def replay(self):
+        """读取未完成任务的检查点，没有时返回 None"""
+        if not os.path.exists(self.path): return None
+        state = {"groups": None, "mode": None, "done": set(), "failed": {}, "cursors": {}, "groups_done": set()}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # 进程被杀时最后一行可能只写了一半
+                event = record.get("event")
+                if event == "start":
+                    state["groups"] = record.get("groups")
+                    state["mode"] = record.get("mode", "routine")
+                elif event == "done":
+                    state["done"].add(record["id"]); state["failed"].pop(record["id"], None)
+                elif event == "failed":
+                    state["failed"][record["id"]] = record
+                elif event == "cursor":
+                    state["cursors"][record["group"]] = record["page"]
+                elif event == "group_done":
+                    state["groups_done"].add(record["group"])
+        return state
+
+    def open(self, groups, mode, resume):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'a' if resume else 'w', encoding='utf-8')
+        if not resume: self.append({"event": "start", "groups": groups, "mode": mode, "time": int(time.time())})
+
+    def append(self, record):
+        with self.lock:
+            if self.file is None: return
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self, finished):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            if finished and os.path.exists(self.path):
+                os.remove(self.path)
+
+def load_watermarks():
+    """每个搜索的水位线: {query: {"high_water": 最大ID, "updated": 时间, "backfill_page": 回溯进度}}"""
+    if not os.path.exists(WATERMARK_FILE): return {}
+    try:
+        with open(WATERMARK_FILE, 'r', encoding='utf-8') as f: return json.load(f)
+    except (json.JSONDecodeError, FileNotFoundError): return {}
+
+def save_watermarks(watermarks):
+    tmp_path = WATERMARK_FILE + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f: json.dump(watermarks, f, indent=4, ensure_ascii=False)
+    os.replace(tmp_path, WATERMARK_FILE)
 
 def sanitize_filename(name):
     return "".join([c for c in name if c.isalpha() or c.isdigit() or c in (' ', '-', '_')]).rstrip()
 
-def download_image(url, path, session, retries=3, delay=5):
-    """下载单张图片，并带有重试机制"""
-    for i in range(retries):
-        if stop_event.is_set(): return False
-        try:
-            proxies = app_config.get("proxies", {})
-            valid_proxies = {k: v for k, v in proxies.items() if v}
-            response = session.get(url, headers=HEADERS, proxies=valid_proxies or None, timeout=30)
-            response.raise_for_status()
-            with open(path, 'wb') as f: f.write(response.content)
-            return True
-        except Exception as e:
-            logging.warning(f"下载图片失败 ({i+1}/{retries}): {url}, 错误: {e}. {delay}秒后重试...")
-            if i < retries - 1:
-                time.sleep(delay)
-    logging.error(f"下载图片失败，已达最大重试次数: {url}")
-    return False
+# --- HTTP 会话管理 ---
+# 所有任务共用一个长期存在的 cloudscraper 会话，避免每个任务重新通过 Cloudflare 验证
+# 和建立连接。Cloudflare 放行 cookie 保存在数据目录，重启后继续使用；
+# 代理只在建会话时设置一次，代理配置变化或需要更大的连接池时才重建会话。
+
+def configured_proxies():
+    proxies = app_config.get("proxies", {})
+    return {k: v for k, v in proxies.items() if v}
+
+def required_pool_size():
+    """连接池大小需覆盖所有并发请求: 每本漫画的页面线程 × 同时下载的漫画数 + 元数据和搜索线程"""
+    concurrent = (int(app_config.get("page_workers", 4)) * int(app_config.get("comic_workers", 2))
+                  + int(app_config.get("metadata_workers", 2)) + int(app_config.get("group_workers", 3)))
+    return max(10, concurrent + 4)
+
+class SessionManager:
+    def __init__(self, cookie_file):
+        self.cookie_file = cookie_file
+        self.lock = threading.Lock()
+        self.session = None
+        self.proxies = None
+        self.pool_size = None
+
+    def get(self):
+        proxies = configured_proxies()
+        pool_size = required_pool_size()
+        with self.lock:
+            if self.session is None or proxies != self.proxies or pool_size > self.pool_size:
+                if self.session is not None:
+                    self._save_cookies_locked()
+                    logging.info("代理或并发配置已变化，重建 HTTP 会话。")
+                self.session = self._build(proxies, pool_size)
+                self.proxies = proxies
+                self.pool_size = pool_size
+            return self.session
+
+    def _build(self, proxies, pool_size):
+        session = cloudscraper.create_scraper()
+        for prefix in ('https://', 'http://'):
+            adapter = session.get_adapter(prefix)
+            adapter._pool_connections = max(adapter._pool_connections, 4)
+            adapter._pool_maxsize = pool_size
+            adapter.init_poolmanager(adapter._pool_connections, pool_size, block=adapter._pool_block)
+        session.proxies.update(proxies)
+        self._load_cookies(session)
+        return session
+
+    def _load_cookies(self, session):
+        if not os.path.exists(self.cookie_file): return
+        try:
+            with open(self.cookie_file, 'r', encoding='utf-8') as f:
+                cookies = json.load(f)
+            now = time.time()
+            for c in cookies:
+                if c.get("expires") and c["expires"] < now: continue
+                session.cookies.set(c["name"], c["value"], domain=c.get("domain", ""), path=c.get("path", "/"),
+                                    expires=c.get("expires"), secure=c.get("secure", False))
+            logging.info(f"已加载 {len(cookies)} 个保存的会话 cookie。")
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"加载会话 cookie 失败: {e}")
+
+    def _save_cookies_locked(self):
+        if self.session is None: return
+        cookies = [{"name": c.name, "value": c.value, "domain": c.domain, "path": c.path,
+                    "expires": c.expires, "secure": c.secure} for c in self.session.cookies]
+        try:
+            tmp_path = self.cookie_file + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cookies, f, indent=4)
+            os.replace(tmp_path, self.cookie_file)
+        except OSError as e:
+            logging.warning(f"保存会话 cookie 失败: {e}")
+
+    def save_cookies(self):
+        with self.lock:
+            self._save_cookies_locked()
+
+session_manager = SessionManager(SESSION_COOKIE_FILE)
+
+def get_session():
+    return session_manager.get()
+
+# --- 自适应限速 ---
+# nhentai.net (HTML) 和 i.nhentai.net (图片 CDN) 各有一个令牌桶。请求成功时速率缓慢线性上升，
+# 遇到 429/503 时速率减半，并按 Retry-After 或带抖动的指数退避暂停该主机的所有请求，
+# 最终收敛到源站能容忍的最大速率。
+THROTTLE_STATUS_CODES = (429, 503)
+GONE_STATUS_CODES = (404, 410)  # 画廊已被删除，重试也不会成功
+MAX_BACKOFF_SECONDS = 300
+
+def backoff_delay(attempt, base=2.0):
+    """第 attempt 次(从 0 开始)重试前的等待时间: 指数增长并带 ±50% 抖动"""
+    return min(MAX_BACKOFF_SECONDS, base * (2 ** attempt)) * random.uniform(0.5, 1.5)
+
+def parse_retry_after(value):
+    """Retry-After 可以是秒数或 HTTP 日期"""
+    if not value: return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+class AdaptiveRateLimiter:
+    """单个主机的自适应令牌桶"""
+    def __init__(self, host, rate, min_rate, max_rate):
+        self.host = host
+        self.min_rate = max(float(min_rate), 0.01)
+        self.max_rate = max(float(max_rate), self.min_rate)
+        self.rate = min(max(float(rate), self.min_rate), self.max_rate)
+        self.tokens = 1.0
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.consecutive_throttles = 0
+        self.throttle_count = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """取得一个令牌；等待期间收到停止命令时返回 False"""
+        while not job_cancelled():
+            with self.lock:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    wait = self.blocked_until - now
+                else:
+                    self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return True
+                    wait = (1 - self.tokens) / self.rate
+            job_wait(min(wait, 1.0))
+        return False
+
+    def on_success(self):
+        with self.lock:
+            self.consecutive_throttles = 0
+            # 加性增长: 大约每秒提高 max_rate 的 2%
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.02 / self.rate)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.consecutive_throttles += 1
+            self.throttle_count += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Retry-After 来自服务器，同样不超过退避上限，避免一个异常的值让整个主机长时间停摆
+            delay = min(retry_after, MAX_BACKOFF_SECONDS) if retry_after is not None else backoff_delay(self.consecutive_throttles - 1)
+            now = time.monotonic()
+            self.blocked_until = max(self.blocked_until, now + delay)
+            self.tokens = 0.0
+            self.updated = now
+        logging.warning(f"{self.host} 返回限流响应，速率降为 {self.rate:.2f}/秒，暂停 {delay:.1f} 秒。")
+        return delay
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "rate": round(self.rate, 3),
+                "paused_seconds": round(max(0.0, self.blocked_until - time.monotonic()), 1),
+                "throttled": self.throttle_count
+            }
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(url):
+    host = urlsplit(url).hostname or ""
+    with rate_limiters_lock:
+        limiter = rate_limiters.get(host)
+        if limiter is None:
+            settings = app_config.get("rate_limits", DEFAULT_CONFIG["rate_limits"])
+            limits = settings.get(host) or settings.get("nhentai.net") or {"rate": 1.0, "min_rate": 0.1, "max_rate": 4.0}
+            limiter = rate_limiters[host] = AdaptiveRateLimiter(host, limits.get("rate", 1.0), limits.get("min_rate", 0.1), limits.get("max_rate", 4.0))
+    return limiter
+
+def request_kind(url):
+    """按地址区分请求类型，用于指标标签"""
+    parts = urlsplit(url)
+    if parts.hostname == "i.nhentai.net": return "image"
+    if parts.path.startswith("/search"): return "search"
+    if parts.path.startswith("/g/"): return "gallery"
+    return "other"
+
+def http_get(session, url, stream=False, max_throttle_retries=5, headers=None, **kwargs):
+    """所有对外请求的统一入口：按主机限速，并在 429/503 时退避重试。
+    停止时抛出 InterruptedError；重试耗尽时返回最后一次的响应，由调用方 raise_for_status。"""
+    limiter = get_rate_limiter(url)
+    host, kind = limiter.host, request_kind(url)
+    request_headers = {**HEADERS, **headers} if headers else HEADERS
+    # 每个请求都显式传入配置的代理：只设在 session.proxies 上时，环境变量 HTTP(S)_PROXY 会优先生效
+    kwargs.setdefault("proxies", session_manager.proxies)
+    for attempt in range(max_throttle_retries + 1):
+        waited = time.perf_counter()
+        if not limiter.acquire(): raise InterruptedError("任务被手动停止")
+        started = time.perf_counter()
+        RATE_LIMIT_WAIT_SECONDS.inc(started - waited, host=host)
+        try:
+            response = session.get(url, headers=request_headers, timeout=30, stream=stream, **kwargs)
+        except Exception:
+            HTTP_REQUESTS.inc(host=host, kind=kind, status="error")
+            raise
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, host=host, kind=kind)
+        HTTP_REQUESTS.inc(host=host, kind=kind, status=str(response.status_code))
+        if response.status_code not in THROTTLE_STATUS_CODES:
+            limiter.on_success()
+            return response
+        HTTP_THROTTLED.inc(host=host, status=str(response.status_code))
+        limiter.on_throttle(parse_retry_after(response.headers.get('Retry-After')))
+        if attempt == max_throttle_retries: break
+        RETRIES.inc(kind="throttle")
+        response.close()
+    return response
+
+# --- 页面完整性校验 ---
+# 每本漫画目录下的 .pages.json 记录 gallery_id 和下载时服务器报告的每页字节数。
+# 知道服务器端的长度时只核对长度；不知道时才检查图片格式的文件头和文件尾，
+# 无法识别的格式记为无法校验，不当作损坏。损坏的页面优先用 Range 续传修复。
+PAGE_MANIFEST_NAME = ".pages.json"
+IMAGE_TAIL_BYTES = 64
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+PAGE_OK = "ok"
+PAGE_UNVERIFIABLE = "unverifiable"
+PAGE_USABLE = (PAGE_OK, PAGE_UNVERIFIABLE)
+PAGE_PROBLEMS = {
+    "missing": "文件不存在",
+    "empty": "文件为空",
+    "truncated": "文件长度不足",
+    "oversized": "文件长度超出服务器报告的大小",
+    "bad_trailer": "缺少图片结束标记"
+}
+
+def image_format(head):
+    """根据文件头判断图片格式，无法识别时返回 None"""
+    if head.startswith(b'\xff\xd8\xff'): return 'jpeg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'): return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'): return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP': return 'webp'
+    return None
+
+def inspect_image(path, expected_size=None):
+    """检查图片文件，返回 PAGE_OK、PAGE_UNVERIFIABLE 或 PAGE_PROBLEMS 中的问题类型。
+    expected_size 是服务器报告的长度，给出时只核对长度，不再用文件头尾推测。"""
+    try:
+        size = os.path.getsize(path)
+        if size == 0: return "empty"
+        if expected_size is not None:
+            if size < expected_size: return "truncated"
+            if size > expected_size: return "oversized"
+            return PAGE_OK
+        with open(path, 'rb') as f:
+            head = f.read(16)
+            f.seek(max(0, size - IMAGE_TAIL_BYTES))
+            tail = f.read()
+    except FileNotFoundError:
+        return "missing"
+    fmt = image_format(head)
+    if fmt is None: return PAGE_UNVERIFIABLE
+    if fmt == 'jpeg':
+        ok = b'\xff\xd9' in tail
+    elif fmt == 'png':
+        ok = tail.endswith(b'IEND\xaeB`\x82')
+    elif fmt == 'gif':
+        ok = tail.rstrip(b'\x00').endswith(b';')
+    else:
+        # RIFF 头里记录了整个文件的长度
+        riff_size = int.from_bytes(head[4:8], 'little') + 8
+        if size < riff_size: return "truncated"
+        ok = True
+    return PAGE_OK if ok else "bad_trailer"
+
+def load_page_manifest(comic_path):
+    """读取漫画目录的页面清单，不存在或损坏时返回空清单"""
+    try:
+        with open(os.path.join(comic_path, PAGE_MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest.get("pages"), dict): return manifest
+    except (FileNotFoundError, json.JSONDecodeError, AttributeError):
+        pass
+    return {"gallery_id": None, "pages": {}}
+
+def save_page_manifest(comic_path, manifest):
+    manifest_path = os.path.join(comic_path, PAGE_MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(tmp_path, manifest_path)
+
+def prepare_page_repair(path, problem):
+    """为修复损坏页面做准备：只缺结尾的文件移到临时文件等待续传，其余直接删除后整页重下"""
+    if not os.path.exists(path): return
+    tmp_path = path + ".part"
+    resumable = problem in ("truncated", "bad_trailer")
+    if resumable and (not os.path.exists(tmp_path) or os.path.getsize(tmp_path) < os.path.getsize(path)):
+        os.replace(path, tmp_path)
+    else:
+        os.remove(path)
+
+def record_page_sizes(comic_path, manifest, gallery_id, pages):
+    """把刚下载完成的页面大小写入清单；下载时已按服务器报告的长度校验过，因此就是服务器端的大小"""
+    changed = manifest.get("gallery_id") != gallery_id
+    manifest["gallery_id"] = gallery_id
+    for _, _, path in pages:
+        try:
+            manifest["pages"][os.path.basename(path)] = os.path.getsize(path)
+            changed = True
+        except FileNotFoundError:
+            pass
+    if changed:
+        try: save_page_manifest(comic_path, manifest)
+        except OSError as e: logging.warning(f"保存页面清单失败: {comic_path}, 错误: {e}")
+
+def fetch_image_to_part(session, url, tmp_path):
+    """把图片写入临时文件：已有部分内容时用 Range 续传，服务器不支持时从头下载。
+    返回服务器报告的总字节数（未知时为 None）；失败时保留临时文件供下次续传。"""
+    offset = os.path.getsize(tmp_path) if os.path.exists(tmp_path) else 0
+    # 续传时要求不压缩，否则无法把两段内容直接拼接
+    headers = {'Range': f'bytes={offset}-', 'Accept-Encoding': 'identity'} if offset else None
+    with http_get(session, url, stream=True, headers=headers) as response:
+        if offset and response.status_code == 416:
+            os.remove(tmp_path)
+            raise IOError("临时文件已不短于服务器上的文件，丢弃后从头下载")
+        response.raise_for_status()
+        total = None
+        if offset and response.status_code == 206:
+            content_range = response.headers.get('Content-Range', '')
+            match = CONTENT_RANGE_RE.match(content_range)
+            if not match or int(match.group(1)) != offset:
+                os.remove(tmp_path)
+                raise IOError(f"服务器返回的续传区间不符: {content_range}")
+            if match.group(3) != '*': total = int(match.group(3))
+            mode = 'ab'
+        else:
+            if offset: logging.info(f"  服务器不支持断点续传，从头下载: {url}")
+            offset, mode = 0, 'wb'
+            # 压缩传输时 Content-Length 是压缩后的长度，无法用于校验
+            if response.headers.get('Content-Encoding', 'identity') == 'identity' and response.headers.get('Content-Length'):
+                total = int(response.headers['Content-Length'])
+        written = offset
+        with open(tmp_path, mode) as f:
+            for chunk in response.iter_content(chunk_size=IMAGE_CHUNK_SIZE):
+                if job_cancelled(): raise InterruptedError("下载任务被手动停止")
+                if chunk:
+                    f.write(chunk)
+                    written += len(chunk)
+                    add_job_bytes(len(chunk))
+                    DOWNLOADED_BYTES.inc(len(chunk))
+        if total is not None and written != total:
+            raise IOError(f"图片不完整: 收到 {written} 字节，期望 {total} 字节")
+    return total
+
+def download_image(url, path, session, retries=3):
+    """流式下载单张图片到临时文件，校验长度和图片头尾后原子替换到目标路径，失败时指数退避重试。
+    中断或失败时保留临时文件，下次用 Range 请求续传。"""
+    tmp_path = path + ".part"
+    for i in range(retries):
+        if job_cancelled(): return False
+        try:
+            total = fetch_image_to_part(session, url, tmp_path)
+            problem = inspect_image(tmp_path, total)
+            if problem not in PAGE_USABLE:
+                os.remove(tmp_path)
+                raise IOError(f"图片校验失败: {PAGE_PROBLEMS[problem]}")
+            os.replace(tmp_path, path)
+            PAGES_DOWNLOADED.inc()
+            return True
+        except InterruptedError:
+            break
+        except Exception as e:
+            delay = backoff_delay(i)
+            logging.warning(f"下载图片失败 ({i+1}/{retries}): {url}, 错误: {e}. {delay:.1f}秒后重试...")
+            if i < retries - 1:
+                RETRIES.inc(kind="image")
+                RETRY_SLEEP_SECONDS.inc(delay, kind="image")
+                job_wait(delay)
+    if not job_cancelled():
+        logging.error(f"下载图片失败，已达最大重试次数: {url}")
+    return False
+
+def parse_gallery(comic_id, html):
+    """解析漫画详情页，返回包含标题、标签、页数和图片信息的 gallery 字典"""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    title_element = soup.find('h1', class_='title')
+    if not title_element: return None
+    title = title_element.find('span', class_='pretty').text
+
+    all_tags = {}
+    tags_section = soup.find('section', id='tags')
+    if tags_section:
+        tag_containers = tags_section.find_all('div', class_='tag-container')
+        for container in tag_containers:
+            category_name = ""
+            for content in container.contents:
+                if isinstance(content, str) and content.strip():
+                    category_name = content.strip().replace(':', '')
+                    break
+
+            if category_name:
+                tags = [tag.find('span', class_='name').text for tag in container.select('span.tags a.tag')]
+                if tags:
+                    all_tags[category_name] = tags
+
+    gallery_id = None
+    page_exts = []
+    for thumb in soup.find_all('a', class_='gallerythumb'):
+        thumb_url = thumb.find('img')['data-src']
+        if gallery_id is None:
+            gallery_id = thumb_url.split('/galleries/')[1].split('/')[0]
+        page_exts.append(os.path.splitext(thumb_url)[1])
+
+    return {
+        "id": int(comic_id),
+        "title": title,
+        "tags": all_tags,
+        "gallery_id": gallery_id,
+        "page_exts": page_exts,
+        "num_pages": len(page_exts)
+    }
+
+def fetch_gallery(comic_id, session):
+    """请求一次漫画详情页并解析为 gallery 字典"""
+    base_url = f"https://nhentai.net/g/{comic_id}/"
+    response = http_get(session, base_url)
+    response.raise_for_status()
+    with observe_duration(PARSE_SECONDS, kind="gallery"):
+        return parse_gallery(comic_id, response.text)
+
+def apply_gallery_metadata(gallery):
+    """把 gallery 中的标题和标签写入内存中的元数据并记下获取时间，返回标签是否有变化"""
+    comic_id_str = str(gallery["id"])
+    if comic_id_str not in library_metadata: library_metadata[comic_id_str] = {}
+    entry = library_metadata[comic_id_str]
+    changed = entry.get('tags') != gallery["tags"]
+    entry['tags'] = gallery["tags"]
+    entry['title'] = gallery["title"]
+    entry['fetched_at'] = int(time.time())
+    entry.pop('refresh_failures', None)
+    entry.pop('refresh_failed_at', None)
+    return changed
+
+def save_gallery_metadata(gallery):
+    """把 gallery 中的标题和标签写入元数据"""
+    apply_gallery_metadata(gallery)
+    save_comic_metadata(str(gallery["id"]))
 
 def fetch_and_save_metadata(comic_id, session):
-    """只获取并保存元数据"""
-    base_url = f"https://nhentai.net/g/{comic_id}/"
+    """获取并保存元数据，成功时返回 gallery 字典供下载复用"""
     try:
-        proxies = app_config.get("proxies", {})
-        valid_proxies = {k: v for k, v in proxies.items() if v}
-        response = session.get(base_url, headers=HEADERS, proxies=valid_proxies or None, timeout=30)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        title_element = soup.find('h1', class_='title')
-        if not title_element: return False
-        title = title_element.find('span', class_='pretty').text
-
-        all_tags = {}
-        tags_section = soup.find('section', id='tags')
-        if tags_section:
-            tag_containers = tags_section.find_all('div', class_='tag-container')
-            for container in tag_containers:
-                category_name = ""
-                for content in container.contents:
-                    if isinstance(content, str) and content.strip():
-                        category_name = content.strip().replace(':', '')
-                        break
-
-                if category_name:
-                    tags = [tag.find('span', class_='name').text for tag in container.select('span.tags a.tag')]
-                    if tags:
-                        all_tags[category_name] = tags
-
-        comic_id_str = str(comic_id)
-        if comic_id_str not in library_metadata: library_metadata[comic_id_str] = {}
-        library_metadata[comic_id_str]['tags'] = all_tags
-        library_metadata[comic_id_str]['title'] = title
-        save_metadata()
+        gallery = fetch_gallery(comic_id, session)
+        if not gallery:
+            note_failure(comic_id, "详情页解析失败"); return None
+        save_gallery_metadata(gallery)
         logging.info(f"成功刷新漫画 {comic_id} 的元数据。")
-        return True
+        return gallery
+    except InterruptedError:
+        return None
     except Exception as e:
+        status = getattr(getattr(e, 'response', None), 'status_code', None)
+        note_failure(comic_id, f"获取元数据失败: {e}", dead=status in GONE_STATUS_CODES)
         logging.error(f"刷新漫画 {comic_id} 元数据失败: {e}")
-        return False
+        return None
+
+def download_pages(pending_pages, num_pages, session):
+    """使用每本漫画独立的线程池并发下载页面，全部页面成功才返回 True"""
+    if not pending_pages: return True
+    workers = max(1, int(app_config.get("page_workers", 4)))
+    abort_event = threading.Event()
+
+    def fetch_page(i, img_url, img_filepath):
+        if job_cancelled() or abort_event.is_set(): return False
+        logging.info(f"  下载中: 第 {i}/{num_pages} 页 -> {os.path.basename(img_filepath)}")
+        if not download_image(img_url, img_filepath, session):
+            logging.error(f"下载第 {i} 页失败。")
+            abort_event.set()
+            return False
+        return True
+
+    with ThreadPoolExecutor(max_workers=min(workers, len(pending_pages))) as executor:
+        futures = [executor.submit(bind_job(fetch_page), *page) for page in pending_pages]
+        all_ok = True
+        for future in as_completed(futures):
+            try:
+                ok = future.result()
+            except Exception as e:
+                logging.error(f"页面下载线程异常: {e}")
+                ok = False
+            if not ok:
+                all_ok = False
+                abort_event.set()
+                for f in futures: f.cancel()
+    return all_ok and not job_cancelled()
 
-def download_comic(comic_id, session):
-    """下载单本漫画，并响应停止事件"""
-    if stop_event.is_set(): return None
+def download_comic(comic_id, session, gallery=None):
+    """下载单本漫画，并响应停止事件；传入已解析的 gallery 时不再重复请求详情页"""
+    if job_cancelled(): return None
 
-    if not fetch_and_save_metadata(comic_id, session):
+    if gallery is None:
+        gallery = fetch_and_save_metadata(comic_id, session)
+    if not gallery:
         logging.error(f"无法获取漫画 {comic_id} 的元数据，跳过下载。")
         return None
 
-    base_url = f"https://nhentai.net/g/{comic_id}/"
-    logging.info(f"开始处理漫画: {base_url}")
+    logging.info(f"开始处理漫画: https://nhentai.net/g/{comic_id}/")
     try:
-        proxies = app_config.get("proxies", {})
-        valid_proxies = {k: v for k, v in proxies.items() if v}
-        response = session.get(base_url, headers=HEADERS, proxies=valid_proxies or None, timeout=30)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-
-        title = library_metadata.get(str(comic_id), {}).get('title', f"comic_{comic_id}")
+        title = gallery["title"] or f"comic_{comic_id}"
         sanitized_title = sanitize_filename(title)
 
         download_path = app_config.get("download_path")
         comic_folder_name = f"{comic_id}_{sanitized_title}"
         comic_path = os.path.join(download_path, comic_folder_name)
+        if os.path.exists(comic_path + ARCHIVE_EXTENSION):
+            logging.info(f"漫画 {comic_id} 已打包为归档，跳过下载。")
+            return comic_id
         os.makedirs(comic_path, exist_ok=True)
 
-        thumbnail_elements = soup.find_all('a', class_='gallerythumb')
-        num_pages = len(thumbnail_elements)
-        if num_pages == 0: logging.error(f"无法找到漫画 {comic_id} 的任何图片"); return None
+        num_pages = gallery["num_pages"]
+        if num_pages == 0:
+            note_failure(comic_id, "详情页中没有图片"); logging.error(f"无法找到漫画 {comic_id} 的任何图片"); return None
 
         logging.info(f"漫画 '{title}' 共 {num_pages} 页. 开始下载...")
-        first_thumb_url = thumbnail_elements[0].find('img')['data-src']
-        gallery_id = first_thumb_url.split('/galleries/')[1].split('/')[0]
+        gallery_id = gallery["gallery_id"]
 
-        for i, thumb in enumerate(thumbnail_elements, 1):
-            if stop_event.is_set(): logging.info("下载任务被手动停止。"); return None
-            img_tag = thumb.find('img')
-            img_ext = os.path.splitext(img_tag['data-src'])[1]
+        manifest = load_page_manifest(comic_path)
+        page_sizes = manifest["pages"]
+        pending_pages = []
+        for i, img_ext in enumerate(gallery["page_exts"], 1):
             img_url = f"https://i.nhentai.net/galleries/{gallery_id}/{i}{img_ext}"
             img_filename = f"{i}{img_ext}"
             img_filepath = os.path.join(comic_path, img_filename)
 
-            if not os.path.exists(img_filepath):
-                logging.info(f"  下载中: 第 {i}/{num_pages} 页 -> {img_filename}")
-                if not download_image(img_url, img_filepath, session):
-                    logging.error(f"下载第 {i} 页失败，放弃下载此漫画。"); return None
-                time.sleep(0.5)
-            else:
+            problem = inspect_image(img_filepath, page_sizes.get(img_filename))
+            if problem in PAGE_USABLE:
                 logging.info(f"  已存在，跳过: 第 {i}/{num_pages} 页")
+                continue
+            if problem != "missing":
+                logging.warning(f"  第 {i}/{num_pages} 页已损坏 ({PAGE_PROBLEMS[problem]})，重新获取")
+                prepare_page_repair(img_filepath, problem)
+            pending_pages.append((i, img_url, img_filepath))
+
+        pages_ok = download_pages(pending_pages, num_pages, session)
+        record_page_sizes(comic_path, manifest, gallery_id, pending_pages)
+        if not pages_ok:
+            if job_cancelled(): logging.info("下载任务被手动停止。")
+            else:
+                note_failure(comic_id, "有页面下载失败")
+                logging.error(f"漫画 {comic_id} 有页面下载失败，放弃下载此漫画。")
+            return None
 
+        entry = index_comic_folder(comic_folder_name)
+        if storage_uses_archives():
+            try:
+                entry = pack_comic_folder(comic_folder_name)
+            except (OSError, zipfile.BadZipFile) as e:
+                logging.error(f"打包漫画 {comic_id} 失败，保留目录: {e}")
+        get_thumbnail(entry)
+        publish_library_change(comic_folder_name)
+        COMICS_PROCESSED.inc(result="downloaded")
         logging.info(f"漫画 '{title}' 下载完成!")
         return comic_id
     except Exception as e:
+        note_failure(comic_id, f"下载出错: {e}")
         logging.error(f"下载漫画 {comic_id} 图片时发生错误: {e}"); return None
 
-def run_downloader():
-    if not downloader_lock.acquire(blocking=False):
-        logging.warning("下载任务已在运行中，本次请求被跳过。")
-        return
+# --- 流水线下载引擎 ---
+# 搜索翻页 -> 获取元数据 -> 下载图片 三个阶段通过有界队列相连，各阶段并行工作。
+# 停止时搜索阶段不再产生新任务，下游把队列中剩余的任务快速排空后退出。
+# 任一阶段的线程出现未处理的异常时整条流水线中止，队列操作都带超时，不会因下游线程退出而永远阻塞。
+PIPELINE_DONE = object()
+PIPELINE_POLL_SECONDS = 0.5
+
+class PipelineStage:
+    """单个流水线阶段的吞吐统计"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.in_flight = 0
+        self.started = time.time()
+        self.finished = None
+
+    def begin(self):
+        with self.lock: self.in_flight += 1
+
+    def end(self, ok):
+        with self.lock:
+            self.in_flight -= 1
+            self.processed += 1
+            if not ok: self.failed += 1
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = max((self.finished or time.time()) - self.started, 1e-6)
+            return {
+                "processed": self.processed,
+                "failed": self.failed,
+                "in_flight": self.in_flight,
+                "per_minute": round(self.processed * 60 / elapsed, 2)
+            }
+
+class PageTracker:
+    """跟踪每个标签组每个搜索页上的漫画，整页(及之前所有页)都处理完后才写入检查点"""
+    def __init__(self, journal, start_pages):
+        self.journal = journal
+        self.lock = threading.Lock()
+        self.remaining = {}
+        self.next_page = dict(start_pages)
+        self.search_finished = set()
+        self.completed = set()
+
+    def register_page(self, group, page, count):
+        with self.lock:
+            self.remaining[(group, page)] = count
+            self._advance(group)
+
+    def comic_finished(self, group, page):
+        with self.lock:
+            self.remaining[(group, page)] -= 1
+            self._advance(group)
+
+    def search_done(self, group):
+        with self.lock:
+            self.search_finished.add(group)
+            self._advance(group)
+
+    def _advance(self, group):
+        page = self.next_page[group]
+        while self.remaining.get((group, page)) == 0:
+            del self.remaining[(group, page)]
+            self.journal.append({"event": "cursor", "group": group, "page": page})
+            page += 1
+        self.next_page[group] = page
+        if group in self.search_finished and not any(g == group for g, _ in self.remaining):
+            self.search_finished.discard(group)
+            self.completed.add(group)
+            self.journal.append({"event": "group_done", "group": group})
+
+# --- 标签组搜索计划 ---
+# 一个标签组的条件是另一个标签组条件的超集时，它的结果必然包含在后者的搜索结果中，
+# 只需搜索后者一次，再用获取到的元数据在本地判断属于哪些标签组。
+
+def tag_group_terms(tag_group):
+    """把标签组转换为搜索条件元组，如 ('language:"chinese"', 'tag:"loli"')"""
+    terms = []
+    for t in tag_group:
+        t = t.strip().lower()
+        if not t: continue
+        terms.append(f'language:"{t}"' if t in KNOWN_LANGUAGES else f'tag:"{t}"')
+    return tuple(dict.fromkeys(terms))
+
+def gallery_terms(gallery):
+    """漫画元数据中可用于匹配标签组的条件集合"""
+    terms = set()
+    for category, values in gallery.get("tags", {}).items():
+        prefix = "language" if normalize_category(category) == "language" else "tag"
+        if normalize_category(category) not in ("language", "tag"): continue
+        terms.update(f'{prefix}:"{v.strip().lower()}"' for v in values)
+    return terms
+
+def plan_tag_group_searches(target_tag_groups):
+    """分析标签组，返回需要实际发出的最少搜索及其覆盖的标签组"""
+    group_terms = [tag_group_terms(g) for g in target_tag_groups]
+    searches = []
+    for i, terms in enumerate(group_terms):
+        if not terms: continue
+        term_set = set(terms)
+        covered = any(set(other) < term_set or (set(other) == term_set and j < i)
+                      for j, other in enumerate(group_terms) if other)
+        if not covered:
+            searches.append({"query": "+".join(terms), "terms": frozenset(terms), "groups": [i]})
+    for i, terms in enumerate(group_terms):
+        if not terms or any(i in search["groups"] for search in searches): continue
+        # 选条件最多(结果最少)的那个搜索来覆盖
+        best = max((search for search in searches if search["terms"] <= set(terms)), key=lambda search: len(search["terms"]))
+        best["groups"].append(i)
+
+    shared = []
+    for a in range(len(searches)):
+        for b in range(a + 1, len(searches)):
+            common = searches[a]["terms"] & searches[b]["terms"]
+            if common: shared.append({"searches": [a, b], "terms": sorted(common)})
+    return {"searches": searches, "shared": shared, "group_terms": group_terms}
+
+def log_search_plan(plan, target_tag_groups):
+    for search in plan["searches"]:
+        covered = [target_tag_groups[g] for g in search["groups"][1:]]
+        if covered:
+            logging.info(f"搜索计划: {search['query']} 同时覆盖标签组 {covered}，这些标签组不再单独搜索。")
+    for item in plan["shared"]:
+        # 只共享部分条件的标签组不合并：改为只搜索公共条件会翻过所有结果的并集，请求反而更多
+        queries = [plan["searches"][i]["query"] for i in item["searches"]]
+        logging.info(f"搜索计划: {queries} 共享条件 {item['terms']}，结果互不包含，分别搜索。")
+    logging.info(f"搜索计划: {len(target_tag_groups)} 个标签组只需 {len(plan['searches'])} 个远程搜索。")
+
+class CrawlPipeline:
+    """mode 为 routine 时每个搜索只抓取水位线之后的新结果；
+    backfill 时忽略水位线和“整页已下载”的停止条件，一直向后翻页补全历史。"""
+    def __init__(self, session, target_tag_groups, downloaded_ids, journal, checkpoint, watermarks, mode="routine"):
+        self.session = session
+        self.mode = mode
+        self.watermarks = watermarks
+        self.target_tag_groups = target_tag_groups
+        self.plan = plan_tag_group_searches(target_tag_groups)
+        self.searches = self.plan["searches"]
+        log_search_plan(self.plan, target_tag_groups)
+        self.downloaded_ids = downloaded_ids
+        self.journal = journal
+        self.resume = checkpoint is not None
+        self.groups_done = checkpoint["groups_done"] if self.resume else set()
+        # 断点前刚完成的漫画不能触发“整页都已下载”的停止条件，否则会漏掉后面的页
+        self.resumed_ids = checkpoint["done"] if self.resume else set()
+        # 检查点中的 group 指搜索计划中的搜索序号；标签组不变时计划也不变
+        start_pages = {}
+        for i, search in enumerate(self.searches):
+            start_pages[i] = checkpoint["cursors"].get(i, 0) + 1 if self.resume else 1
+            if mode == "backfill":
+                start_pages[i] = max(start_pages[i], self.watermarks.get(search["query"], {}).get("backfill_page", 1))
+        self.page_tracker = PageTracker(journal, start_pages)
+        self.start_pages = start_pages
+
+        queue_size = max(1, int(app_config.get("pipeline_queue_size", 20)))
+        self.id_queue = queue.Queue(maxsize=queue_size)
+        self.gallery_queue = queue.Queue(maxsize=queue_size)
+        self.metadata_workers = max(1, int(app_config.get("metadata_workers", 2)))
+        self.comic_workers = max(1, int(app_config.get("comic_workers", 2)))
+        self.stages = {name: PipelineStage(name) for name in ("search", "metadata", "download")}
+        self.group_workers = max(1, int(app_config.get("group_workers", 3)))
+        self.group_queue = queue.Queue()
+        for i in range(len(self.searches)): self.group_queue.put(i)
+        self.state_lock = threading.Lock()
+        self.claimed_ids = set()
+        self.new_comics = 0
+        self.search_pages = [0] * len(self.searches)
+        self.seen_max_ids = [0] * len(self.searches)
+        self.search_errors = 0
+        self.worker_errors = []
+        self.aborted = threading.Event()
+        self.group_matches = [0] * len(target_tag_groups)
+
+    def planner_report(self):
+        """合并掉的标签组如果单独搜索，其结果是覆盖它的搜索结果的子集，
+        最多需要同样多的页数，以此估计节省的请求数"""
+        merged = 0
+        saved_requests = 0
+        for i, search in enumerate(self.searches):
+            merged += len(search["groups"]) - 1
+            saved_requests += (len(search["groups"]) - 1) * self.search_pages[i]
+        return {
+            "tag_groups": len(self.target_tag_groups),
+            "remote_searches": len(self.searches),
+            "merged_groups": merged,
+            "saved_requests_estimate": saved_requests,
+            "group_matches": {"+".join(g): n for g, n in zip(self.target_tag_groups, self.group_matches)}
+        }
+
+    def snapshot(self):
+        return {
+            "queues": {"ids": self.id_queue.qsize(), "galleries": self.gallery_queue.qsize()},
+            "stages": {name: stage.snapshot() for name, stage in self.stages.items()},
+            "new_comics": self.new_comics,
+            "planner": self.planner_report()
+        }
+
+    def run(self):
+        search_threads = [threading.Thread(target=self.stage_thread(self.search_worker), name=f"crawl-search-{n}") for n in range(self.group_workers)]
+        metadata_threads = [threading.Thread(target=self.stage_thread(self.metadata_worker), name=f"crawl-metadata-{n}") for n in range(self.metadata_workers)]
+        download_threads = [threading.Thread(target=self.stage_thread(self.download_worker), name=f"crawl-download-{n}") for n in range(self.comic_workers)]
+        for t in search_threads + metadata_threads + download_threads: t.start()
+
+        for t in search_threads: t.join()
+        for _ in metadata_threads: self.put_item(self.id_queue, PIPELINE_DONE)
+        for t in metadata_threads: t.join()
+        for _ in download_threads: self.put_item(self.gallery_queue, PIPELINE_DONE)
+        for t in download_threads: t.join()
+        for stage in self.stages.values(): stage.finished = time.time()
+        return not job_cancelled() and self.search_errors == 0 and not self.aborted.is_set()
+
+    def stage_thread(self, worker):
+        """包装阶段线程：出现未处理的异常时记下错误并中止整条流水线"""
+        def run():
+            try:
+                worker()
+            except Exception as e:
+                logging.exception(f"流水线线程 {threading.current_thread().name} 出错，中止本次任务: {e}")
+                with self.state_lock:
+                    self.worker_errors.append(f"{threading.current_thread().name}: {e}")
+                self.aborted.set()
+        return bind_job(run)
+
+    def stopping(self):
+        return job_cancelled() or self.aborted.is_set()
+
+    def put_item(self, q, item):
+        """放入有界队列；流水线中止时放弃并返回 False"""
+        while not self.aborted.is_set():
+            try:
+                q.put(item, timeout=PIPELINE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def next_item(self, q):
+        """从队列取下一项；流水线中止且队列已空时返回 PIPELINE_DONE"""
+        while True:
+            try:
+                return q.get(timeout=PIPELINE_POLL_SECONDS)
+            except queue.Empty:
+                if self.aborted.is_set(): return PIPELINE_DONE
+
+    # --- 阶段一: 搜索翻页 ---
+    # 多个标签组并行搜索，共享 nhentai.net 的限速器；已被其他标签组认领的漫画不会重复获取
+    def search_worker(self):
+        while not self.stopping():
+            try:
+                i = self.group_queue.get_nowait()
+            except queue.Empty:
+                return
+            search = self.searches[i]
+            if i in self.groups_done:
+                logging.info(f"搜索 {search['query']} 在上次任务中已完成，跳过。"); continue
+            groups = [self.target_tag_groups[g] for g in search["groups"]]
+            logging.info(f"--- 开始第 {i+1}/{len(self.searches)} 个搜索: {search['query']} (标签组: {groups}) ---")
+            if self.search_group(i, search["query"]):
+                self.page_tracker.search_done(i)
+
+    def search_group(self, group_index, query):
+        """逐页执行一个搜索，把新漫画放入队列；搜索自然结束时返回 True"""
+        search_url = f"https://nhentai.net/search/?q={query}"
+        page = self.start_pages[group_index]
+        backfill = self.mode == "backfill"
+        watermark = None if backfill else self.watermarks.get(query, {}).get("high_water")
+        while not self.stopping():
+            stage = self.stages["search"]
+            stage.begin()
+            try:
+                url = f"{search_url}&page={page}"
+                logging.info(f"正在搜索第 {page} 页: {url}")
+                response = http_get(self.session, url)
+                response.raise_for_status()
+                with observe_duration(PARSE_SECONDS, kind="search"):
+                    soup = BeautifulSoup(response.text, 'html.parser')
+                    galleries = soup.find_all('div', class_='gallery')
+                    page_comic_ids = [int(g.find('a')['href'].strip('/').split('/')[-1]) for g in galleries]
+                self.search_pages[group_index] += 1
+                stage.end(True)
+            except InterruptedError:
+                stage.end(False)
+                break
+            except Exception as e:
+                stage.end(False)
+                # 出错的搜索不算完成：不推进水位线，检查点也会保留到下次任务继续
+                with self.state_lock: self.search_errors += 1
+                logging.error(f"搜索或解析页面时失败: {e}"); logging.warning("由于网络或解析错误，此标签组的搜索提前结束。")
+                return False
+
+            if not galleries: logging.info("当前页没有找到更多漫画，此标签组搜索结束。"); return True
+            self.seen_max_ids[group_index] = max(self.seen_max_ids[group_index], max(page_comic_ids))
+            # 搜索结果按上传时间倒序，出现不高于水位线的 ID 说明已经翻到上次任务看过的位置
+            reached_watermark = False
+            if watermark is not None:
+                fresh_ids = [cid for cid in page_comic_ids if cid > watermark]
+                reached_watermark = len(fresh_ids) < len(page_comic_ids)
+                page_comic_ids = fresh_ids
+            # 已失效或还在退避期内的失败漫画留给重试队列处理，这里当作已知
+            blocked_ids = {cid for cid in page_comic_ids if is_retry_blocked(cid)}
+            with self.state_lock:
+                new_ids_on_page = [cid for cid in page_comic_ids
+                                   if cid not in self.downloaded_ids and cid not in self.claimed_ids and cid not in blocked_ids]
+                known = all(cid in self.downloaded_ids or cid in self.claimed_ids or cid in blocked_ids for cid in page_comic_ids)
+                self.claimed_ids.update(new_ids_on_page)
+            if not backfill and not reached_watermark and known and self.resumed_ids.isdisjoint(page_comic_ids):
+                logging.info(f"第 {page} 页的所有漫画都已下载过，停止搜索此标签组。"); return True
+
+            self.page_tracker.register_page(group_index, page, len(new_ids_on_page))
+            if new_ids_on_page and current_job(): current_job().add_total(len(new_ids_on_page))
+            for comic_id in new_ids_on_page:
+                logging.info(f"发现新漫画，ID: {comic_id}")
+                if not self.put_item(self.id_queue, {"id": comic_id, "group": group_index, "page": page}): return False
+            if reached_watermark:
+                logging.info(f"第 {page} 页已到达水位线 {watermark}，此搜索结束。"); return True
+            page += 1
+        if job_cancelled(): logging.info("下载任务被手动停止。")
+        return False
+
+    # --- 阶段二: 获取元数据 ---
+    def metadata_worker(self):
+        stage = self.stages["metadata"]
+        while True:
+            item = self.next_item(self.id_queue)
+            if item is PIPELINE_DONE: return
+            if self.stopping():
+                self.finish_comic(item, None); continue
+            stage.begin()
+            gallery = fetch_and_save_metadata(item["id"], self.session)
+            stage.end(gallery is not None)
+            if not gallery:
+                logging.error(f"无法获取漫画 {item['id']} 的元数据，跳过下载。")
+                self.finish_comic(item, False); continue
+            item["gallery"] = gallery
+            self.count_group_matches(gallery)
+            if not self.put_item(self.gallery_queue, item): return
 
-    stop_event.clear()
+    def count_group_matches(self, gallery):
+        """用获取到的元数据在本地判断漫画属于哪些标签组"""
+        terms = gallery_terms(gallery)
+        with self.state_lock:
+            for g, group_terms in enumerate(self.plan["group_terms"]):
+                if group_terms and terms.issuperset(group_terms):
+                    self.group_matches[g] += 1
+
+    # --- 阶段三: 下载图片 ---
+    def download_worker(self):
+        stage = self.stages["download"]
+        while True:
+            item = self.next_item(self.gallery_queue)
+            if item is PIPELINE_DONE: return
+            if self.stopping():
+                self.finish_comic(item, None); continue
+            stage.begin()
+            ok = False
+            try:
+                ok = bool(download_comic(item["id"], self.session, item["gallery"]))
+            finally:
+                stage.end(ok)
+                self.finish_comic(item, ok)
+
+    def update_watermarks(self):
+        """把本次任务的进度写回水位线。只有搜索到的漫画全部处理完(已下载或已记入失败列表)
+        的搜索才推进水位线，避免中途停止时漏掉水位线以下的漫画。"""
+        now = int(time.time())
+        for i, search in enumerate(self.searches):
+            mark = self.watermarks.setdefault(search["query"], {})
+            completed = i in self.page_tracker.completed
+            if self.mode == "backfill":
+                if completed:
+                    mark.pop("backfill_page", None)
+                    mark["backfill_completed"] = now
+                else:
+                    mark["backfill_page"] = self.page_tracker.next_page[i]
+            elif completed and self.seen_max_ids[i]:
+                mark["high_water"] = max(mark.get("high_water", 0), self.seen_max_ids[i])
+                mark["updated"] = now
+            if not mark: del self.watermarks[search["query"]]
+
+    def finish_comic(self, item, ok):
+        """记录单本漫画的结果；ok 为 None 表示被停止，不算成功也不算失败"""
+        comic_id = item["id"]
+        if ok is None or (not ok and job_cancelled()):
+            return
+        if current_job(): current_job().advance()
+        if ok:
+            with self.state_lock:
+                self.downloaded_ids.add(comic_id)
+                self.new_comics += 1
+            record_success(comic_id)
+            self.journal.append({"event": "done", "id": comic_id})
+        else:
+            record = record_failure(comic_id)
+            self.journal.append({"event": "failed", "id": comic_id, "reason": record["reason"],
+                                 "dead": record["dead"], "time": record["last_failed"]})
+        self.page_tracker.comic_finished(item["group"], item["page"])
+
+def run_downloader(job, mode="routine"):
+    """mode: routine 为日常增量抓取，backfill 为回溯历史页"""
+    journal = CrawlJournal(CRAWL_JOURNAL_FILE)
     try:
-        logging.info("--- 开始执行下载任务 ---")
+        logging.info(f"--- 开始执行下载任务 ({'回溯历史' if mode == 'backfill' else '增量抓取'}) ---")
         download_path = app_config.get("download_path")
         os.makedirs(download_path, exist_ok=True)
         downloaded_ids = set(load_download_log())
-        failed_ids_set = set(library_metadata.get('failed_ids', []))
-        session = cloudscraper.create_scraper()
-        new_comics_found_in_session = 0
+        session = get_session()
         target_tag_groups = app_config.get("target_tag_groups", [])
 
-        for i, tag_group in enumerate(target_tag_groups):
-            if stop_event.is_set(): logging.info("下载任务被手动停止。"); break
-            logging.info(f"--- 开始搜索第 {i+1}/{len(target_tag_groups)} 组标签: {tag_group} ---")
-
-            query_parts = [f'language:"{t}"' if t.lower() in KNOWN_LANGUAGES else f'tag:"{t}"' for t in tag_group]
-            query = "+".join(query_parts)
+        # 上次任务中断时，从检查点恢复已完成的漫画和各标签组的搜索进度
+        checkpoint = journal.replay()
+        resume = checkpoint is not None and checkpoint["groups"] == target_tag_groups and checkpoint["mode"] == mode
+        if checkpoint:
+            downloaded_ids.update(checkpoint["done"])
+            for comic_id in checkpoint["done"]: record_success(comic_id)
+            for comic_id, record in checkpoint["failed"].items():
+                record_failure(comic_id, record.get("reason", "未知错误"), record.get("dead", False), record.get("time", 0))
+            if resume:
+                logging.info(f"从检查点恢复: 已完成 {len(checkpoint['done'])} 本，已结束 {len(checkpoint['groups_done'])} 个标签组。")
+            else:
+                logging.info("标签组配置或任务模式已变化，检查点中的搜索进度作废，只保留已完成的漫画。")
+                # 重新开始会清空日志，先把其中的结果写入下载记录和失败队列，否则中途退出时会丢失
+                save_download_log(downloaded_ids)
+                save_failed_ids()
+        journal.open(target_tag_groups, mode, resume)
 
-            search_url = f"https://nhentai.net/search/?q={query}"
-            page = 1
-            while not stop_event.is_set():
-                try:
-                    url = f"{search_url}&page={page}"
-                    logging.info(f"正在搜索第 {page} 页: {url}")
-                    proxies = app_config.get("proxies", {})
-                    valid_proxies = {k: v for k, v in proxies.items() if v}
-                    response = session.get(url, headers=HEADERS, proxies=valid_proxies or None, timeout=30)
-                    response.raise_for_status()
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    galleries = soup.find_all('div', class_='gallery')
-                    if not galleries: logging.info("当前页没有找到更多漫画，此标签组搜索结束。"); break
-                    page_comic_ids = [int(g.find('a')['href'].strip('/').split('/')[-1]) for g in galleries]
-                    new_ids_on_page = [cid for cid in page_comic_ids if cid not in downloaded_ids]
-                    if not new_ids_on_page: logging.info(f"第 {page} 页的所有漫画都已下载过，停止搜索此标签组。"); break
-                    for comic_id in new_ids_on_page:
-                        if stop_event.is_set(): break
-                        logging.info(f"发现新漫画，ID: {comic_id}")
-                        downloaded_id = download_comic(comic_id, session)
-                        if downloaded_id:
-                            downloaded_ids.add(downloaded_id)
-                            new_comics_found_in_session += 1
-                            if comic_id in failed_ids_set: failed_ids_set.remove(comic_id)
-                        else:
-                            if not stop_event.is_set(): failed_ids_set.add(comic_id)
-                    page += 1; time.sleep(2)
-                except Exception as e:
-                    logging.error(f"搜索或解析页面时失败: {e}"); logging.warning("由于网络错误，此标签组的搜索提前结束。"); break
+        watermarks = load_watermarks()
+        pipeline = CrawlPipeline(session, target_tag_groups, downloaded_ids, journal,
+                                       checkpoint if resume else None, watermarks, mode)
+        job.describe = lambda: {"pipeline": pipeline.snapshot()}
+        finished = pipeline.run()
+        pipeline.update_watermarks()
+        save_watermarks(watermarks)
 
-        library_metadata['failed_ids'] = list(failed_ids_set)
-        save_metadata()
+        save_failed_ids()
         save_download_log(downloaded_ids)
-        logging.info(f"--- 所有标签组搜索完毕，本次任务共下载了 {new_comics_found_in_session} 本新漫画 ---")
+        # 完整跑完才删除检查点；被停止时保留，下次从断点继续
+        journal.close(finished)
+        report = pipeline.planner_report()
+        logging.info(f"搜索计划: {report['tag_groups']} 个标签组实际执行 {report['remote_searches']} 个搜索，"
+                     f"合并 {report['merged_groups']} 个标签组，估计节省 {report['saved_requests_estimate']} 次搜索请求。")
+        if pipeline.worker_errors:
+            raise RuntimeError(f"下载流水线中止，检查点已保留: {'; '.join(pipeline.worker_errors)}")
+        logging.info(f"--- 所有标签组搜索完毕，本次任务共下载了 {pipeline.new_comics} 本新漫画 ---")
     finally:
-        downloader_lock.release()
-
-def retry_failed_downloads():
-    if not downloader_lock.acquire(blocking=False):
-        logging.warning("下载/重试任务已在运行中，本次请求被跳过。")
-        return
+        journal.close(finished=False)
+        session_manager.save_cookies()
 
-    stop_event.clear()
+def retry_failed_downloads(job, force=False):
+    """并发重试到期的失败漫画，请求仍受各主机共享的限速约束；已失效的漫画不再重试"""
     try:
         logging.info("--- 开始重试失败的下载 ---")
-        failed_ids_to_retry = library_metadata.get('failed_ids', []).copy()
+        failed_ids_to_retry = eligible_failed_ids(force)
+        summary = failed_ids_summary()
         if not failed_ids_to_retry:
-            logging.info("没有需要重试的漫画。")
+            logging.info(f"没有到期需要重试的漫画 (等待中 {summary['retryable']} 本，已失效 {summary['dead']} 本)。")
             return
+        job.set_total(len(failed_ids_to_retry))
+        logging.info(f"本次重试 {len(failed_ids_to_retry)} 本，跳过退避中的 {summary['retryable'] - len(failed_ids_to_retry)} 本"
+                     f"和已失效的 {summary['dead']} 本。")
 
-        session = cloudscraper.create_scraper()
+        session = get_session()
         successfully_retried_ids = set()
 
-        for comic_id in failed_ids_to_retry:
-            if stop_event.is_set(): logging.info("重试任务被手动停止。"); break
+        def retry_one(comic_id):
+            if job_cancelled(): return None
             logging.info(f"重试下载: {comic_id}")
-            if download_comic(comic_id, session):
-                successfully_retried_ids.add(comic_id)
+            return download_comic(comic_id, session)
+
+        workers = max(1, int(app_config.get("comic_workers", 2)))
+        with ThreadPoolExecutor(max_workers=min(workers, len(failed_ids_to_retry))) as executor:
+            futures = {executor.submit(bind_job(retry_one), comic_id): comic_id for comic_id in failed_ids_to_retry}
+            for future in as_completed(futures):
+                comic_id = futures[future]
+                job.advance()
+                try:
+                    ok = future.result()
+                except Exception as e:
+                    note_failure(comic_id, f"重试出错: {e}"); ok = None
+                if ok:
+                    record_success(comic_id)
+                    successfully_retried_ids.add(comic_id)
+                elif not job_cancelled():
+                    record = record_failure(comic_id)
+                    if record["dead"]: logging.warning(f"漫画 {comic_id} 已确认失效，不再重试: {record['reason']}")
+        if job_cancelled(): logging.info("重试任务被手动停止。")
 
         if successfully_retried_ids:
             logging.info(f"成功重试 {len(successfully_retried_ids)} 本漫画。")
-            current_failed_set = set(library_metadata.get('failed_ids', []))
-            current_failed_set.difference_update(successfully_retried_ids)
-            library_metadata['failed_ids'] = list(current_failed_set)
-            save_metadata()
+            save_download_log(set(load_download_log()) | successfully_retried_ids)
+        save_failed_ids()
     finally:
-        downloader_lock.release()
+        session_manager.save_cookies()
 
-def refresh_metadata_task():
-    """遍历本地文件，为缺少元数据的漫画补充信息"""
-    if not downloader_lock.acquire(blocking=False):
-        logging.warning("已有任务在运行中，无法刷新元数据。")
-        return
+def metadata_refresh_candidates(full=False):
+    """需要刷新的漫画: 缺少标签的排在最前(从未尝试过的优先)，其余超过 TTL 的按上次获取时间从旧到新排，
+    两者合计最多 metadata_refresh_limit 本，让全库按滚动的节奏逐步更新。
+    上次刷新失败的漫画按失败次数退避(同失败重试队列)，退避期内不再尝试。full 时刷新全部。"""
+    ttl = float(app_config.get("metadata_ttl_days", 30)) * 86400
+    now = time.time()
+    with library_index_lock:
+        comic_ids = list(library_index)
+    missing, stale = [], []
+    for comic_id_str in comic_ids:
+        entry = library_metadata.get(comic_id_str, {})
+        failures = entry.get('refresh_failures', 0)
+        failed_at = entry.get('refresh_failed_at', 0)
+        if not full and failures and now < failed_at + retry_delay(failures): continue
+        fetched_at = entry.get('fetched_at', 0)
+        # 获取过但确实没有标签的画廊按 TTL 刷新，不当作缺失
+        if not entry.get('tags') and not fetched_at: missing.append((failed_at, comic_id_str))
+        elif full or (ttl > 0 and now - fetched_at >= ttl): stale.append((fetched_at, comic_id_str))
+    candidates = [comic_id_str for _, comic_id_str in sorted(missing) + sorted(stale)]
+    limit = int(app_config.get("metadata_refresh_limit", 500))
+    if limit > 0 and not full: candidates = candidates[:limit]
+    return candidates
 
-    stop_event.clear()
+def note_refresh_failure(comic_id_str):
+    """记下元数据刷新失败的次数和时间，供 metadata_refresh_candidates 退避"""
+    entry = library_metadata.setdefault(comic_id_str, {})
+    entry['refresh_failures'] = entry.get('refresh_failures', 0) + 1
+    entry['refresh_failed_at'] = int(time.time())
+
+def refresh_metadata_task(job, full=False):
+    """并发获取缺失或过期的元数据，按批写入存储"""
     try:
         logging.info("--- 开始刷新本地漫画元数据 ---")
-        download_path = app_config.get("download_path")
-        if not os.path.exists(download_path):
-            logging.warning("下载目录不存在，无法刷新。")
+        candidates = metadata_refresh_candidates(full)
+        job.set_total(len(candidates))
+        progress = job.details
+        progress.update({"refreshed": 0, "changed": 0, "failed": 0})
+        if not candidates:
+            logging.info("没有缺失或过期的元数据。")
             return
 
-        session = cloudscraper.create_scraper()
-        refreshed_count = 0
-        subdirs = [d for d in os.listdir(download_path) if os.path.isdir(os.path.join(download_path, d))]
+        session = get_session()
+        batch_size = max(1, int(app_config.get("metadata_batch_size", 50)))
+        workers = max(1, int(app_config.get("metadata_workers", 2)))
+        batch = []
 
-        for folder in subdirs:
-            if stop_event.is_set(): logging.info("元数据刷新任务被手动停止。"); break
+        def fetch(comic_id_str):
+            if job_cancelled(): return None
             try:
-                comic_id_str = folder.split('_')[0]
-                # If tags object is empty or doesn't exist, refresh it
-                if not library_metadata.get(comic_id_str, {}).get('tags'):
-                    logging.info(f"发现缺少元数据的漫画: {comic_id_str}，正在刷新...")
-                    if fetch_and_save_metadata(int(comic_id_str), session):
-                        refreshed_count += 1
-                        time.sleep(1)
-                    else:
-                        logging.warning(f"刷新 {comic_id_str} 失败，将跳过。")
-            except (ValueError, IndexError):
-                logging.warning(f"目录 '{folder}' 名称不规范，跳过刷新。")
-
-        logging.info(f"--- 元数据刷新完成，共刷新了 {refreshed_count} 本漫画 ---")
+                return fetch_gallery(int(comic_id_str), session)
+            except InterruptedError:
+                return None
+            except Exception as e:
+                logging.warning(f"刷新 {comic_id_str} 失败，将跳过: {e}")
+                return None
+
+        # 获取在线程池中并发进行，写入只在当前线程按批提交
+        with ThreadPoolExecutor(max_workers=min(workers, len(candidates))) as executor:
+            futures = {executor.submit(bind_job(fetch), comic_id_str): comic_id_str for comic_id_str in candidates}
+            for future in as_completed(futures):
+                gallery = future.result()
+                job.advance()
+                if gallery:
+                    progress["changed"] += apply_gallery_metadata(gallery)
+                    progress["refreshed"] += 1
+                    batch.append(futures[future])
+                elif not job_cancelled():
+                    progress["failed"] += 1
+                    note_refresh_failure(futures[future])
+                    batch.append(futures[future])
+                if len(batch) >= batch_size:
+                    save_comics_metadata(batch); batch = []
+                    logging.info(f"元数据刷新进度: {job.done}/{job.total}，{job.snapshot()['rate']} 本/秒")
+        if batch: save_comics_metadata(batch)
+        if job_cancelled(): logging.info("元数据刷新任务被手动停止。")
+
+        logging.info(f"--- 元数据刷新完成，共刷新了 {progress['refreshed']} 本漫画 (标签有变化 {progress['changed']} 本，"
+                     f"失败 {progress['failed']} 本)，{job.snapshot()['rate']} 本/秒 ---")
+    finally:
+        session_manager.save_cookies()
+
+def find_bad_pages(entry, comic_path, page_sizes):
+    """检查目录中的每一页，返回 [(页面名, 问题类型)]"""
+    bad_pages = []
+    for name in entry["pages"]:
+        problem = inspect_image(os.path.join(comic_path, name), page_sizes.get(name))
+        if problem not in PAGE_USABLE: bad_pages.append((name, problem))
+    # 清单里记录过、但目录中已经不存在的页面
+    bad_pages.extend((name, "missing") for name in page_sizes if name not in entry["pages"])
+    return bad_pages
+
+def verify_archive_pages(entry, download_path, session):
+    """按 CRC 校验归档中的每一页；有损坏时解回目录，按目录的方式修复后重新打包"""
+    archive_path = os.path.join(download_path, comic_disk_name(entry))
+    bad = 0
+    try:
+        with zipfile.ZipFile(archive_path) as zf:
+            for name in entry["pages"]:
+                try:
+                    zf.read(name)
+                except (zipfile.BadZipFile, OSError):
+                    bad += 1
+    except (zipfile.BadZipFile, OSError) as e:
+        logging.error(f"无法读取漫画归档 {archive_path}: {e}")
+        return len(entry["pages"]), len(entry["pages"]), 0
+    if not bad: return len(entry["pages"]), 0, 0
+
+    logging.warning(f"  漫画 {entry['id']} 的归档中有 {bad} 页损坏，解包后修复")
+    folder_entry = unpack_comic_archive(entry["folder"])
+    publish_library_change(entry["folder"])
+    if not folder_entry: return len(entry["pages"]), bad, 0
+    checked, _, repaired = verify_comic_pages(folder_entry, download_path, session)
+    # 全部页面完好时重新打包；否则留下目录，等下次校验或扫描继续修复
+    comic_path = os.path.join(download_path, entry["folder"])
+    folder_entry = index_comic_folder(entry["folder"])
+    if (folder_entry and folder_entry["page_count"] >= entry["page_count"]
+            and not find_bad_pages(folder_entry, comic_path, load_page_manifest(comic_path)["pages"])):
+        try:
+            pack_comic_folder(entry["folder"])
+            publish_library_change(entry["folder"])
+        except (OSError, zipfile.BadZipFile) as e:
+            logging.error(f"重新打包漫画 {entry['id']} 失败，保留目录: {e}")
+    return checked, bad, repaired
+
+def verify_comic_pages(entry, download_path, session):
+    """校验一本漫画的全部页面并修复损坏的页面，返回 (检查页数, 损坏页数, 修复页数)"""
+    if entry["archive"]: return verify_archive_pages(entry, download_path, session)
+    comic_path = os.path.join(download_path, entry["folder"])
+    manifest = load_page_manifest(comic_path)
+    page_sizes = manifest["pages"]
+    bad_pages = find_bad_pages(entry, comic_path, page_sizes)
+    checked = len(entry["pages"])
+    if not bad_pages: return checked, 0, 0
+
+    gallery_id = manifest.get("gallery_id")
+    if not gallery_id:
+        try:
+            gallery = fetch_gallery(int(entry["id"]), session)
+        except InterruptedError:
+            return checked, len(bad_pages), 0
+        except Exception as e:
+            logging.error(f"获取漫画 {entry['id']} 详情失败，无法修复: {e}")
+            return checked, len(bad_pages), 0
+        if not gallery:
+            logging.error(f"无法解析漫画 {entry['id']} 的详情页，无法修复。")
+            return checked, len(bad_pages), 0
+        gallery_id = gallery["gallery_id"]
+
+    pending_pages = []
+    for name, problem in bad_pages:
+        logging.warning(f"  漫画 {entry['id']} 第 {name} 页损坏 ({PAGE_PROBLEMS[problem]})，尝试修复")
+        path = os.path.join(comic_path, name)
+        prepare_page_repair(path, problem)
+        pending_pages.append((page_sort_key(name), f"https://i.nhentai.net/galleries/{gallery_id}/{name}", path))
+    download_pages(pending_pages, entry["page_count"], session)
+    record_page_sizes(comic_path, manifest, gallery_id, pending_pages)
+    index_comic_folder(entry["folder"])
+    publish_library_change(entry["folder"])
+    repaired = sum(1 for _, _, path in pending_pages if os.path.exists(path))
+    return checked, len(bad_pages), repaired
+
+def verify_library_task(job):
+    """全库校验页面的长度与图片头尾，修复损坏或缺失的页面；完好的页面不会重新下载"""
+    try:
+        logging.info("--- 开始校验本地漫画页面 ---")
+        download_path = app_config.get("download_path")
+        with library_index_lock:
+            entries = sorted(library_index.values(), key=lambda e: e["folder"])
+        job.set_total(len(entries))
+        progress = job.details
+        progress.update({"pages_checked": 0, "bad_pages": 0, "repaired": 0})
+        session = get_session()
+        for entry in entries:
+            if job_cancelled(): logging.info("校验任务被手动停止。"); break
+            checked, bad, repaired = verify_comic_pages(entry, download_path, session)
+            progress["pages_checked"] += checked
+            progress["bad_pages"] += bad
+            progress["repaired"] += repaired
+            job.advance()
+
+        logging.info(f"--- 校验完成: 检查 {progress['pages_checked']} 页，发现损坏 {progress['bad_pages']} 页，"
+                     f"修复 {progress['repaired']} 页 ---")
     finally:
-        downloader_lock.release()
+        session_manager.save_cookies()
+
+def archive_library_task(job):
+    """把已下载完成的漫画目录就地打包成 CBZ 归档；不在下载记录中或有损坏页面的目录留给校验任务处理"""
+    logging.info("--- 开始把漫画目录打包为 CBZ 归档 ---")
+    download_path = app_config.get("download_path")
+    downloaded = {str(cid) for cid in load_download_log()}
+    with library_index_lock:
+        entries = sorted((e for e in library_index.values() if not e["archive"]), key=lambda e: e["folder"])
+    job.set_total(len(entries))
+    progress = job.details
+    progress.update({"packed": 0, "skipped": 0, "failed": 0})
+    for entry in entries:
+        if job_cancelled(): logging.info("打包任务被手动停止。"); break
+        comic_path = os.path.join(download_path, entry["folder"])
+        if (entry["id"] not in downloaded or not entry["pages"]
+                or find_bad_pages(entry, comic_path, load_page_manifest(comic_path)["pages"])):
+            progress["skipped"] += 1
+        else:
+            try:
+                pack_comic_folder(entry["folder"])
+                publish_library_change(entry["folder"])
+                progress["packed"] += 1
+            except (OSError, zipfile.BadZipFile) as e:
+                logging.error(f"打包漫画 {entry['folder']} 失败: {e}")
+                progress["failed"] += 1
+        job.advance()
+    logging.info(f"--- 打包完成: 打包 {progress['packed']} 本，跳过 {progress['skipped']} 本(未下载完成或有损坏页面)，"
+                 f"失败 {progress['failed']} 本 ---")
 
 
 def scheduled_downloader():
@@ -359,12 +2898,41 @@ def scheduled_downloader():
         time.sleep(check_interval * 3600)
 
         logging.info("定时任务启动，开始自动扫描...")
-        run_downloader()
+        job_scheduler.submit("crawl", run_downloader, ("routine",), name="定时扫描")
+        # 退避时间已到的失败漫画交给重试任务；它与扫描冲突，会排在扫描结束后运行
+        if eligible_failed_ids():
+            job_scheduler.submit("retry", retry_failed_downloads, (False,), name="失败重试")
+        # 每轮顺带刷新一批过期的元数据，与扫描并行运行
+        if float(app_config.get("metadata_ttl_days", 30)) > 0:
+            job_scheduler.submit("metadata", refresh_metadata_task, (False,), name="刷新过期元数据")
 
+# 任务类型对应的任务函数；其他工作进程提交的命令只带任务类型和参数
+JOB_TARGETS = {
+    "crawl": run_downloader,
+    "retry": retry_failed_downloads,
+    "metadata": refresh_metadata_task,
+    "verify": verify_library_task,
+    "archive": archive_library_task,
+    "thumbnails": backfill_thumbnails_task
+}
 
 # --- 前端网页服务 (Flask) ---
 app = Flask(__name__)
 
+# 只统计漫画列表接口和图片文件的处理耗时
+TIMED_ENDPOINTS = {"get_comics": "/api/comics", "serve_comic_files": "/comics/*", "serve_thumbnail": "/thumbs/*"}
+
+@app.before_request
+def start_request_timer():
+    if request.endpoint in TIMED_ENDPOINTS: g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_time(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        HANDLER_SECONDS.observe(time.perf_counter() - started, endpoint=TIMED_ENDPOINTS[request.endpoint])
+    return response
+
 # --- HTML, CSS, JS 模板 ---
 STYLE_CSS = """
 :root{--bg-color:#202124;--text-color:#e8eaed;--card-bg:#303134;--border-color:#5f6368;--accent-color:#8ab4f8;--success-color:#34a853;--error-color:#ea4335;--favorite-color:#fbbc04}
@@ -379,10 +2947,16 @@ h1,h2{color:var(--accent-color);border-bottom:2px solid var(--border-color);padd
 .form-group label{display:block;margin-bottom:5px}
 .form-group input{width:100%;padding:8px;box-sizing:border-box;background-color:var(--bg-color);color:var(--text-color);border:1px solid var(--border-color);border-radius:4px}
 .button-group{display:flex;flex-wrap:wrap;gap:10px;margin-top:10px}
-#save-btn,#run-stop-btn,#retry-btn,#sort-btn,#refresh-btn{background-color:var(--accent-color);color:var(--bg-color);border:none;padding:10px 20px;border-radius:5px;cursor:pointer;font-weight:bold}
+#save-btn,#run-stop-btn,#retry-btn,#sort-btn,#refresh-btn,#backfill-btn,#verify-btn,#archive-btn{background-color:var(--accent-color);color:var(--bg-color);border:none;padding:10px 20px;border-radius:5px;cursor:pointer;font-weight:bold}
 #run-stop-btn.running{background-color:var(--error-color)}
+#job-list{margin-top:10px;font-size:.9em}
+.job-item{display:flex;gap:12px;align-items:center;padding:4px 0;border-top:1px solid var(--border-color)}
+.job-item span:first-child{flex:1}
+.job-done,.job-cancelled{opacity:.6}
+.job-failed{color:var(--error-color)}
+.job-cancel{background-color:var(--error-color);color:var(--bg-color);border:none;padding:2px 10px;border-radius:4px;cursor:pointer}
 #retry-btn{background-color:#fd7e14}
-#sort-btn,#refresh-btn{background-color:#6c757d}
+#sort-btn,#refresh-btn,#backfill-btn,#verify-btn,#archive-btn{background-color:#6c757d}
 #save-status{margin-left:15px;font-weight:bold;align-self:center}
 .filter-controls{display:flex;flex-wrap:wrap;gap:20px;align-items:center}
 #search-box{flex-grow:1}
@@ -451,13 +3025,17 @@ INDEX_HTML = f"""
                     <button id="run-stop-btn">立即执行一次扫描</button>
                     <button id="retry-btn" style="display: none;"></button>
                     <button id="refresh-btn">刷新元数据</button>
+                    <button id="backfill-btn" title="忽略水位线，向后翻页补全历史漫画">回溯历史</button>
+                    <button id="verify-btn" title="检查所有页面的完整性，只重新获取损坏的页面">校验修复</button>
+                    <button id="archive-btn" title="把已下载完成的漫画目录打包为 CBZ 归档，每本漫画只占一个文件">打包归档</button>
                     <span id="save-status"></span>
                 </div>
+                <div id="job-list"></div>
             </div>
             <div class="filter-section">
                 <h2>筛选与排序</h2>
                 <div class="filter-controls">
-                    <input type="text" id="search-box" class="form-group" placeholder="按标题或标签搜索...">
+                    <input type="text" id="search-box" class="form-group" placeholder="按标题或标签搜索，支持 tag:loli、artist:xxx、-排除词">
                     <div class="toggle-switch">
                         <label for="show-favorites">只看收藏</label>
                         <input type="checkbox" id="show-favorites">
@@ -489,6 +3067,10 @@ INDEX_HTML = f"""
         const runStopBtn = document.getElementById('run-stop-btn');
         const retryBtn = document.getElementById('retry-btn');
         const refreshBtn = document.getElementById('refresh-btn');
+        const backfillBtn = document.getElementById('backfill-btn');
+        const verifyBtn = document.getElementById('verify-btn');
+        const archiveBtn = document.getElementById('archive-btn');
+        const jobList = document.getElementById('job-list');
         const sortBtn = document.getElementById('sort-btn');
         const saveStatus = document.getElementById('save-status');
         const searchBox = document.getElementById('search-box');
@@ -497,8 +3079,14 @@ INDEX_HTML = f"""
         const paginationContainer = document.getElementById('pagination');
         
         // 状态变量
+        // 默认由服务端筛选分页；地址带 ?legacy 时沿用旧的前端全量筛选模式
+        const legacyMode = new URLSearchParams(window.location.search).has('legacy');
         let allComics = [];
         let filteredComics = [];
+        let pageComics = [];
+        let totalComics = 0;
+        let latestRequest = 0;
+        let searchTimer = null;
         let currentPage = 1;
         const comicsPerPage = 24;
         let currentSort = 'desc'; // 'desc' or 'asc'
@@ -511,9 +3099,32 @@ INDEX_HTML = f"""
 
         // --- 核心渲染逻辑 ---
         function render() {{
+            if (!legacyMode) return loadServerPage();
             applyFiltersAndSort();
+            totalComics = filteredComics.length;
+            const totalPages = Math.max(Math.ceil(totalComics / comicsPerPage), 1);
+            if (currentPage > totalPages) currentPage = totalPages;
+            const startIndex = (currentPage - 1) * comicsPerPage;
+            pageComics = filteredComics.slice(startIndex, startIndex + comicsPerPage);
             renderCurrentPage();
             renderPagination();
+            return Promise.resolve();
+        }}
+
+        function loadServerPage() {{
+            const params = new URLSearchParams({{
+                q: searchBox.value.trim(), favorites: showFavorites.checked ? '1' : '0',
+                sort: currentSort, page: currentPage, page_size: comicsPerPage
+            }});
+            const requestId = ++latestRequest;
+            return fetch(`/api/comics?${{params}}`).then(r => r.json()).then(data => {{
+                if (requestId !== latestRequest) return;
+                pageComics = data.items;
+                totalComics = data.total;
+                currentPage = data.page;
+                renderCurrentPage();
+                renderPagination();
+            }});
         }}
 
         function applyFiltersAndSort() {{
@@ -544,20 +3155,10 @@ INDEX_HTML = f"""
         }}
         
         function renderCurrentPage() {{
-            const startIndex = (currentPage - 1) * comicsPerPage;
-            const endIndex = startIndex + comicsPerPage;
-            const pageComics = filteredComics.slice(startIndex, endIndex);
-
-            if (pageComics.length === 0 && currentPage > 1) {{
-                currentPage--;
-                renderCurrentPage();
-                return;
-            }}
-
             comicWall.innerHTML = pageComics.map(comic => `
                 <div class="comic-item" data-id="${{comic.id}}" data-folder="${{comic.folder}}">
                     <a href="/reader?comic=${{encodeURIComponent(comic.folder)}}">
-                        <img src="/comics/${{encodeURIComponent(comic.folder)}}/${{encodeURIComponent(comic.cover)}}" alt="${{comic.title}}" loading="lazy">
+                        <img src="/thumbs/${{encodeURIComponent(comic.folder)}}" alt="${{comic.title}}" loading="lazy">
                         <div class="title">${{comic.title}}</div>
                     </a>
                     <div class="comic-actions">
@@ -570,13 +3171,13 @@ INDEX_HTML = f"""
                     </div>
                 </div>
             `).join('');
-            if (filteredComics.length === 0) {{
+            if (totalComics === 0) {{
                  comicWall.innerHTML = '<p>没有找到符合条件的漫画。</p>';
             }}
         }}
 
         function renderPagination() {{
-            const totalPages = Math.ceil(filteredComics.length / comicsPerPage);
+            const totalPages = Math.ceil(totalComics / comicsPerPage);
             paginationContainer.innerHTML = '';
             if (totalPages <= 1) return;
             
@@ -588,29 +3189,73 @@ INDEX_HTML = f"""
         }}
 
 
+        // --- 后台任务列表 ---
+        const JOB_STATES = {{ queued: '排队中', running: '运行中', cancelling: '正在取消', done: '已完成', cancelled: '已取消', failed: '出错' }};
+        const formatBytes = (n) => n >= 1048576 ? `${{(n / 1048576).toFixed(1)}} MB` : `${{Math.round(n / 1024)}} KB`;
+        const formatDuration = (sec) => sec >= 3600 ? `${{Math.floor(sec / 3600)}}时${{Math.round(sec % 3600 / 60)}}分` : sec >= 60 ? `${{Math.floor(sec / 60)}}分${{Math.round(sec % 60)}}秒` : `${{Math.round(sec)}}秒`;
+
+        function renderJobs(jobs) {{
+            const active = jobs.filter(j => ['queued', 'running', 'cancelling'].includes(j.state));
+            const recent = jobs.filter(j => !active.includes(j)).slice(0, 3);
+            jobList.innerHTML = active.concat(recent).map(j => {{
+                let progress = j.total ? `${{j.done}}/${{j.total}}` : (j.done ? `${{j.done}}` : '');
+                if (j.bytes) progress += ` · ${{formatBytes(j.bytes)}}`;
+                if (j.eta_seconds !== null && j.state === 'running') progress += ` · 剩余约 ${{formatDuration(j.eta_seconds)}}`;
+                const cancel = ['queued', 'running'].includes(j.state) ? `<button class="job-cancel" data-id="${{j.id}}">取消</button>` : '';
+                return `<div class="job-item job-${{j.state}}"><span>#${{j.id}} ${{j.name}}</span><span>${{JOB_STATES[j.state] || j.state}}</span><span>${{progress}}</span>${{cancel}}</div>`;
+            }}).join('');
+        }}
+
+        // --- 任务状态 ---
+        function applyStatus(data) {{
+            const isRunning = data.running;
+            const failedCount = data.failed_count || 0;
+
+            const jobs = data.jobs || [];
+            saveBtn.disabled = jobs.some(j => ['queued', 'running', 'cancelling'].includes(j.state) && j.type !== 'thumbnails');
+            renderJobs(jobs);
+            runStopBtn.disabled = isRunning && !runStopBtn.classList.contains('running');
+
+            if(isRunning) {{ runStopBtn.textContent='停止任务'; runStopBtn.classList.add('running'); }}
+            else {{ runStopBtn.textContent='立即执行一次扫描'; runStopBtn.classList.remove('running'); }}
+
+            const retryQueue = data.retry_queue || {{}};
+            if(failedCount > 0) {{
+                retryBtn.style.display='inline-block'; retryBtn.textContent=`重试失败 (${{retryQueue.eligible || 0}}/${{failedCount}})`;
+                retryBtn.title = `到期可重试 ${{retryQueue.eligible || 0}} 本，退避中 ${{failedCount - (retryQueue.eligible || 0)}} 本，已失效 ${{retryQueue.dead || 0}} 本`;
+            }}
+            else {{ retryBtn.style.display='none'; }}
+        }}
+
+        function pollStatus() {{
+            const poll = () => fetch('/api/downloader_status').then(r => {{
+                if (!r.ok) {{ throw new Error("Network response was not ok"); }}
+                return r.json();
+            }}).then(applyStatus).catch(error => {{
+                console.error("Error fetching status:", error);
+            }});
+            poll();
+            setInterval(poll, 2000);
+        }}
+
+        // 优先使用服务器推送；浏览器不支持或连接从未建立成功时退回轮询。
+        // 连接建立过之后的断开由 EventSource 按服务器给出的 retry 间隔自动重连。
+        function watchStatus() {{
+            if (!window.EventSource) return pollStatus();
+            const source = new EventSource('/api/status_stream');
+            let opened = false;
+            source.onopen = () => {{ opened = true; }};
+            source.addEventListener('status', e => applyStatus(JSON.parse(e.data)));
+            source.onerror = () => {{
+                if (opened) return;
+                source.close();
+                pollStatus();
+            }};
+        }}
+
         // --- 事件监听与状态管理 ---
         function setupEventListeners() {{
-            setInterval(() => {{
-                fetch('/api/downloader_status').then(r => {{
-                    if (!r.ok) {{ throw new Error("Network response was not ok"); }}
-                    return r.json();
-                }}).then(data => {{
-                    const isRunning = data.running;
-                    const failedCount = data.failed_count || 0;
-                    
-                    saveBtn.disabled = isRunning;
-                    refreshBtn.disabled = isRunning;
-                    runStopBtn.disabled = isRunning && !runStopBtn.classList.contains('running');
-                    
-                    if(isRunning) {{ runStopBtn.textContent='停止任务'; runStopBtn.classList.add('running'); }}
-                    else {{ runStopBtn.textContent='立即执行一次扫描'; runStopBtn.classList.remove('running'); }}
-                    
-                    if(failedCount > 0) {{ retryBtn.style.display='inline-block'; retryBtn.textContent=`重试失败 (${{failedCount}})`; retryBtn.disabled = isRunning; }}
-                    else {{ retryBtn.style.display='none'; }}
-                }}).catch(error => {{
-                    console.error("Error fetching status:", error);
-                }});
-            }}, 2000);
+            watchStatus();
 
             // 配置按钮
             saveBtn.addEventListener('click', () => {{
@@ -628,9 +3273,10 @@ INDEX_HTML = f"""
                 }} catch (e) {{ showStatus(`格式错误: ${{e.message}}`, true); }}
             }});
 
-            const taskButtonHandler = (endpoint, actionText) => {{
+            const taskButtonHandler = (endpoint, actionText, body) => {{
                 showStatus(`已发送${{actionText}}命令...`);
-                fetch(endpoint, {{ method: 'POST' }})
+                const options = body ? {{ method: 'POST', headers: {{'Content-Type': 'application/json'}}, body: JSON.stringify(body) }} : {{ method: 'POST' }};
+                fetch(endpoint, options)
                 .then(r => r.json()).then(data => {{
                     if(data.status !== 'success') showStatus(data.message, true); else showStatus(data.message || `命令已发送`);
                 }}).catch(e => showStatus(`命令发送失败: ${{e.message}}`, true));
@@ -642,10 +3288,22 @@ INDEX_HTML = f"""
             }});
             retryBtn.addEventListener('click', () => taskButtonHandler('/api/retry_failed', '重试'));
             refreshBtn.addEventListener('click', () => taskButtonHandler('/api/refresh_metadata', '刷新元数据'));
+            backfillBtn.addEventListener('click', () => taskButtonHandler('/api/run_downloader', '回溯历史', {{ mode: 'backfill' }}));
+            verifyBtn.addEventListener('click', () => taskButtonHandler('/api/verify_library', '校验修复'));
+            archiveBtn.addEventListener('click', () => taskButtonHandler('/api/archive_library', '打包归档'));
+            jobList.addEventListener('click', (e) => {{
+                const button = e.target.closest('.job-cancel');
+                if (button) taskButtonHandler(`/api/jobs/${{button.dataset.id}}/cancel`, '取消');
+            }});
 
 
             // 筛选和排序按钮
-            searchBox.addEventListener('input', () => {{ currentPage = 1; render(); }});
+            searchBox.addEventListener('input', () => {{
+                currentPage = 1;
+                if (legacyMode) {{ render(); return; }}
+                clearTimeout(searchTimer);
+                searchTimer = setTimeout(render, 200);
+            }});
             showFavorites.addEventListener('change', () => {{ currentPage = 1; render(); }});
             sortBtn.addEventListener('click', () => {{
                 currentSort = currentSort === 'desc' ? 'asc' : 'desc';
@@ -657,7 +3315,7 @@ INDEX_HTML = f"""
             // 分页按钮
             paginationContainer.addEventListener('click', e => {{
                 if (e.target.id === 'prev-page' && currentPage > 1) {{ currentPage--; render(); }}
-                if (e.target.id === 'next-page' && currentPage < Math.ceil(filteredComics.length / comicsPerPage)) {{ currentPage++; render(); }}
+                if (e.target.id === 'next-page' && currentPage < Math.ceil(totalComics / comicsPerPage)) {{ currentPage++; render(); }}
             }});
 
             // 漫画墙交互
@@ -675,7 +3333,7 @@ INDEX_HTML = f"""
                 if (!target) return;
                 const comicItem = target.closest('.comic-item');
                 const comicId = comicItem.dataset.id;
-                const comic = allComics.find(c => c.id === comicId);
+                const comic = pageComics.find(c => c.id === comicId);
 
                 if (target.classList.contains('favorite')) {{
                      fetch(`/api/favorite/${{comicId}}`, {{ method: 'POST' }})
@@ -692,7 +3350,7 @@ INDEX_HTML = f"""
                         fetch(`/api/comic/${{comicItem.dataset.folder}}`, {{ method: 'DELETE' }})
                         .then(r => r.json()).then(data => {{
                             if (data.status === 'success') {{
-                               allComics = allComics.filter(c => c.id !== comicId);
+                               if (legacyMode) allComics = allComics.filter(c => c.id !== comicId);
                                render();
                             }}
                             modal.style.display = 'none';
@@ -705,7 +3363,8 @@ INDEX_HTML = f"""
 
         // --- 初始化 ---
         function loadComicsAndInitialize() {{
-            fetch('/api/comics').then(r => r.json()).then(data => {{
+            const initialLoad = legacyMode ? fetch('/api/comics').then(r => r.json()) : Promise.resolve([]);
+            initialLoad.then(data => {{
                 document.getElementById('loading').style.display = 'none';
                 allComics = data;
                 const savedStateJSON = sessionStorage.getItem('comicLibraryState');
@@ -718,9 +3377,7 @@ INDEX_HTML = f"""
                     currentSort = savedState.sort || 'desc';
                     sortBtn.textContent = `切换排序 (ID ${{currentSort === 'desc' ? '倒序' : '正序'}})`;
                     
-                    render();
-                    
-                    setTimeout(() => window.scrollTo(0, savedState.scrollY || 0), 100);
+                    render().then(() => setTimeout(() => window.scrollTo(0, savedState.scrollY || 0), 100));
                     sessionStorage.removeItem('comicLibraryState');
                 }} else {{
                     render();
@@ -842,30 +3499,8 @@ def reader(): return render_template_string(READER_HTML)
 @app.route('/api/config', methods=['GET', 'POST'])
 def handle_config():
     if request.method == 'POST':
-        try:
-            new_data = request.get_json()
-            app_config['target_tag_groups'] = new_data.get('target_tag_groups', [])
-            app_config['proxies'] = new_data.get('proxies', {"http": "", "https": ""})
-
-            new_path_relative = new_data.get('download_path', 'comics')
-            new_path_abs = os.path.join(DATA_DIR, new_path_relative)
-
-            old_path_abs = app_config.get("download_path")
-            if old_path_abs != new_path_abs:
-                old_log_file = os.path.join(old_path_abs, "download_log.json")
-                if os.path.exists(old_log_file):
-                    os.makedirs(new_path_abs, exist_ok=True)
-                    new_log_file = os.path.join(new_path_abs, "download_log.json")
-                    shutil.move(old_log_file, new_log_file)
-
-            app_config['download_path'] = new_path_abs
-            save_config()
-            load_data()
-            logging.info("配置已通过网页更新。")
-            return jsonify({"status": "success"})
-        except Exception as e:
-            logging.error(f"更新配置失败: {e}")
-            return jsonify({"status": "error", "message": str(e)}), 400
+        # 由运行任务的 leader 检查任务并应用配置，其他进程随后从配置文件同步
+        return job_command_response("update_config", config=request.get_json())
     else:
         config_copy = app_config.copy()
         display_path = config_copy.get("download_path", "comics")
@@ -874,112 +3509,257 @@ def handle_config():
         config_copy["download_path"] = display_path
         return jsonify(config_copy)
 
+def apply_config_update(new_data):
+    """保存网页提交的配置并重新加载数据，返回 (响应内容, HTTP 状态码)"""
+    try:
+        app_config['target_tag_groups'] = new_data.get('target_tag_groups', [])
+        app_config['proxies'] = new_data.get('proxies', {"http": "", "https": ""})
+
+        new_path_relative = new_data.get('download_path', 'comics')
+        new_path_abs = os.path.join(DATA_DIR, new_path_relative)
+
+        old_path_abs = app_config.get("download_path")
+        if old_path_abs != new_path_abs:
+            old_log_file = os.path.join(old_path_abs, "download_log.json")
+            if os.path.exists(old_log_file):
+                os.makedirs(new_path_abs, exist_ok=True)
+                new_log_file = os.path.join(new_path_abs, "download_log.json")
+                shutil.move(old_log_file, new_log_file)
+
+        app_config['download_path'] = new_path_abs
+        save_config()
+        load_data()
+        logging.info("配置已通过网页更新。")
+        return {"status": "success"}, 200
+    except Exception as e:
+        logging.error(f"更新配置失败: {e}")
+        return {"status": "error", "message": str(e)}, 400
+
+# 这些任务会读写下载目录或元数据存储，运行期间不能修改配置(修改后会重新加载数据)
+CONFIG_LOCKING_JOBS = ("crawl", "retry", "verify", "metadata", "archive")
+
 def is_downloader_running():
-    """Helper to check RLock status correctly."""
-    was_free = downloader_lock.acquire(blocking=False)
-    if was_free:
-        downloader_lock.release()
-    return not was_free
+    """是否有扫描任务在运行或排队"""
+    return bool(job_scheduler.jobs(("crawl",), active_only=True))
+
+def execute_job_command(action, params):
+    """在 leader 进程中执行任务命令，返回 (响应内容, HTTP 状态码)"""
+    if action == "submit":
+        job_type, name = params["type"], params["name"]
+        job, created = job_scheduler.submit(job_type, JOB_TARGETS[job_type], tuple(params["args"]), name=name)
+        if not created:
+            state = "排队" if job.state == "queued" else "运行"
+            return {"status": "success", "message": f"相同的任务已在{state} (#{job.id})", "job": job.snapshot()}, 200
+        message = params["message"]
+        if job.state == "queued":
+            message = f"{name}已加入队列 (#{job.id})，将在前面的任务结束后运行"
+        return {"status": "success", "message": message, "job": job.snapshot()}, 200
+    if action == "cancel":
+        if not job_scheduler.cancel(params["job_id"]):
+            return {"status": "error", "message": "任务不存在或已结束"}, 404
+        logging.info(f"收到取消命令，任务 #{params['job_id']} 将在安全点停止。")
+        return {"status": "success", "message": f"已取消任务 #{params['job_id']}"}, 200
+    if action == "stop_crawl":
+        # 取消所有运行中和排队中的扫描任务，其他类型的任务不受影响
+        jobs = job_scheduler.jobs(("crawl",), active_only=True)
+        if not jobs:
+            return {"status": "error", "message": "当前没有下载任务在运行"}, 409
+        for job in jobs: job_scheduler.cancel(job.id)
+        logging.info("收到停止命令，扫描任务将在安全点停止。")
+        return {"status": "success", "message": "已发送停止命令"}, 200
+    if action == "update_config":
+        # load_data 会关闭正在使用的元数据存储，检查任务和应用配置期间不允许启动新任务
+        applied, result = job_scheduler.run_when_idle(CONFIG_LOCKING_JOBS, lambda: apply_config_update(params["config"]))
+        if not applied:
+            return {"status": "error", "message": "有后台任务在运行或排队，请等待结束后再修改配置"}, 409
+        return result
+    return {"status": "error", "message": f"未知的任务命令: {action}"}, 400
+
+def job_command_response(action, **params):
+    """leader 进程直接执行任务命令，其他工作进程把命令转交给 leader"""
+    if runs_jobs_locally():
+        body, status = execute_job_command(action, params)
+    else:
+        body, status = forward_job_command(action, params)
+    return jsonify(body), status
+
+def submit_job_response(job_type, args, name, message):
+    return job_command_response("submit", type=job_type, args=list(args), name=name, message=message)
+
+def build_status():
+    # 其他工作进程返回 leader 最近发布的状态；leader 还没发布过时本进程没有任务，按空闲计算
+    if not runs_jobs_locally() and leader_status["payload"]: return leader_status["payload"]
+    retry_summary = failed_ids_summary()
+    jobs = job_scheduler.snapshot()
+    crawl = next((j for j in jobs if j["type"] == "crawl" and j["state"] in ("running", "cancelling")), None)
+    return {
+        "running": is_downloader_running(),
+        "failed_count": retry_summary["retryable"],
+        "retry_queue": retry_summary,
+        "pipeline": crawl.get("pipeline") if crawl else None,
+        "rate_limits": {host: limiter.snapshot() for host, limiter in list(rate_limiters.items())},
+        "jobs": jobs
+    }
 
 @app.route('/api/downloader_status', methods=['GET'])
 def downloader_status():
-    return jsonify({
-        "running": is_downloader_running(),
-        "failed_count": len(library_metadata.get('failed_ids', []))
-    })
+    return jsonify(build_status())
+
+# --- 状态推送 (Server-Sent Events) ---
+# 状态有变化时才推送；没有变化时每隔 SSE_HEARTBEAT_SECONDS 发一条注释行保持连接，
+# 同时重新计算一次状态，以便推送字节数、预计剩余时间等随时间变化的字段。
+# 事件 ID 带上进程启动标识，重连时 Last-Event-ID 与当前状态一致就不重复推送。
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+SSE_MIN_INTERVAL = 0.5  # 合并短时间内的多次变化
+SSE_BOOT_ID = f"{int(time.time()):x}"
+
+@app.route('/api/status_stream')
+def status_stream():
+    last_event_id = request.headers.get('Last-Event-ID', '')
+
+    def generate():
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        version = status_notifier.version
+        last_payload = None
+        if last_event_id == f"{SSE_BOOT_ID}-{version}":
+            last_payload = json.dumps(build_status(), ensure_ascii=False, sort_keys=True)
+        last_sent = time.monotonic()
+        while True:
+            payload = json.dumps(build_status(), ensure_ascii=False, sort_keys=True)
+            if payload != last_payload:
+                last_payload = payload
+                yield f"id: {SSE_BOOT_ID}-{version}\nevent: status\ndata: {payload}\n\n"
+                last_sent = time.monotonic()
+                time.sleep(SSE_MIN_INTERVAL)
+            elif time.monotonic() - last_sent >= SSE_HEARTBEAT_SECONDS:
+                yield ": heartbeat\n\n"
+                last_sent = time.monotonic()
+            version = status_notifier.wait(version, SSE_HEARTBEAT_SECONDS)
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    return jsonify(build_status()["jobs"])
+
+@app.route('/api/jobs/<int:job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    return job_command_response("cancel", job_id=job_id)
 
 @app.route('/api/run_downloader', methods=['POST'])
 def trigger_downloader():
-    if is_downloader_running():
-        return jsonify({"status": "error", "message": "下载任务已在运行中"}), 409
-
-    manual_run_thread = threading.Thread(target=run_downloader)
-    manual_run_thread.start()
-    return jsonify({"status": "success", "message": "扫描任务已在后台启动"})
+    mode = (request.get_json(silent=True) or {}).get('mode', 'routine')
+    if mode not in ('routine', 'backfill'):
+        return jsonify({"status": "error", "message": f"未知的任务模式: {mode}"}), 400
+    name = "回溯历史" if mode == "backfill" else "扫描"
+    return submit_job_response("crawl", (mode,), name, "扫描任务已在后台启动")
 
 @app.route('/api/stop_downloader', methods=['POST'])
 def stop_downloader():
-    if not is_downloader_running():
-        return jsonify({"status": "error", "message": "当前没有下载任务在运行"}), 409
-
-    stop_event.set()
-    logging.info("收到停止命令，任务将在安全点停止。")
-    return jsonify({"status": "success", "message": "已发送停止命令"})
+    """取消所有运行中和排队中的扫描任务，其他类型的任务不受影响"""
+    return job_command_response("stop_crawl")
 
 @app.route('/api/retry_failed', methods=['POST'])
 def trigger_retry():
-    if is_downloader_running():
-        return jsonify({"status": "error", "message": "下载任务已在运行中"}), 409
-
-    retry_thread = threading.Thread(target=retry_failed_downloads)
-    retry_thread.start()
-    return jsonify({"status": "success", "message": "失败重试任务已启动"})
+    force = bool((request.get_json(silent=True) or {}).get('force'))
+    if not force and not eligible_failed_ids():
+        summary = failed_ids_summary()
+        if summary["next_retry"] is None:
+            return jsonify({"status": "error", "message": "没有可重试的漫画"}), 409
+        wait_minutes = max(1, int((summary["next_retry"] - time.time()) / 60))
+        return jsonify({"status": "error", "message": f"失败的漫画都在退避期内，约 {wait_minutes} 分钟后可重试"}), 409
+    return submit_job_response("retry", (force,), "失败重试", "失败重试任务已启动")
 
 @app.route('/api/refresh_metadata', methods=['POST'])
 def trigger_refresh_metadata():
-    if is_downloader_running():
-        return jsonify({"status": "error", "message": "已有任务在运行"}), 409
+    full = bool((request.get_json(silent=True) or {}).get('full'))
+    return submit_job_response("metadata", (full,), "刷新元数据", "元数据刷新任务已启动")
+
+@app.route('/api/verify_library', methods=['POST'])
+def trigger_verify_library():
+    return submit_job_response("verify", (), "校验修复", "页面校验任务已启动")
+
+@app.route('/api/archive_library', methods=['POST'])
+def trigger_archive_library():
+    return submit_job_response("archive", (), "打包归档", "打包任务已启动")
 
-    refresh_thread = threading.Thread(target=refresh_metadata_task)
-    refresh_thread.start()
-    return jsonify({"status": "success", "message": "元数据刷新任务已启动"})
 
+def comic_list_item(entry):
+    """把索引条目与元数据合并为列表中的一项"""
+    comic_metadata = library_metadata.get(entry["id"], {})
+    return {
+        "id": entry["id"],
+        "folder": entry["folder"],
+        "title": comic_metadata.get('title', entry["folder"].split('_', 1)[1]),
+        "cover": entry["cover"],
+        "is_favorite": comic_metadata.get('favorite', False),
+        "tags": comic_metadata.get('tags', {})
+    }
+
+def build_comic_list():
+    """完整的漫画列表(没有封面的目录不列出)"""
+    with library_index_lock:
+        entries = list(library_index.values())
+    return [comic_list_item(entry) for entry in entries if entry["cover"]]
 
 @app.route('/api/comics')
 def get_comics():
-    comics = []
-    download_path = app_config.get("download_path")
-    if not os.path.exists(download_path): return jsonify([])
-    try:
-        subdirs = [d for d in os.listdir(download_path) if os.path.isdir(os.path.join(download_path, d))]
-    except FileNotFoundError: return jsonify([])
-    for folder in subdirs:
-        try:
-            parts = folder.split('_', 1)
-            if len(parts) < 2: continue
-            comic_id_str = parts[0]
-
-            comic_dir = os.path.join(download_path, folder)
-            cover_file = None
-            for ext in ['.jpg', '.png', '.jpeg', '.webp']:
-                potential_cover = '1' + ext
-                if os.path.exists(os.path.join(comic_dir, potential_cover)):
-                    cover_file = potential_cover; break
-
-            if cover_file:
-                comic_metadata = library_metadata.get(comic_id_str, {})
-                is_favorite = comic_metadata.get('favorite', False)
-                tags = comic_metadata.get('tags', {})
-                full_title = comic_metadata.get('title', parts[1])
-
-                comics.append({
-                    "id": comic_id_str,
-                    "folder": folder,
-                    "title": full_title,
-                    "cover": cover_file,
-                    "is_favorite": is_favorite,
-                    "tags": tags
-                })
-        except Exception as e:
-            logging.warning(f"处理目录 '{folder}' 时出错: {e}")
-    return jsonify(comics)
+    """不带 page 参数时返回完整列表(旧版前端)，否则在服务端筛选、排序并分页。
+    分页时只对索引条目筛选和排序，只为当前页生成列表项"""
+    if 'page' not in request.args:
+        return jsonify(build_comic_list())
+
+    matched_ids, excluded_ids = search_index.search(request.args.get('q', ''))
+    favorites_only = request.args.get('favorites', '0').lower() in ('1', 'true', 'yes')
+    sort_order = request.args.get('sort', 'desc')
+    page_size = min(max(request.args.get('page_size', 24, type=int) or 24, 1), 500)
+    page = max(request.args.get('page', 1, type=int) or 1, 1)
+
+    with library_index_lock:
+        if matched_ids is None:
+            entries = [e for e in library_index.values() if e["id"] not in excluded_ids]
+        else:
+            entries = [library_index[cid] for cid in matched_ids if cid in library_index]
+    entries = [e for e in entries if e["cover"]]
+    if favorites_only:
+        entries = [e for e in entries if library_metadata.get(e["id"], {}).get('favorite', False)]
+    entries.sort(key=lambda e: int(e["id"]), reverse=(sort_order != 'asc'))
+
+    total = len(entries)
+    total_pages = max((total + page_size - 1) // page_size, 1)
+    page = min(page, total_pages)
+    start = (page - 1) * page_size
+    return jsonify({
+        "items": [comic_list_item(entry) for entry in entries[start:start + page_size]],
+        "total": total,
+        "page": page,
+        "page_size": page_size
+    })
 
 @app.route('/api/comic/<path:comic_folder>', methods=['DELETE'])
 def delete_comic(comic_folder):
     download_path = app_config.get("download_path")
-    if '..' in comic_folder or comic_folder.startswith('/'):
+    if not is_safe_folder_name(comic_folder):
         return jsonify({"status": "error", "message": "Invalid folder name"}), 400
 
     comic_path = os.path.join(download_path, comic_folder)
     try:
-        if os.path.isdir(comic_path):
-            shutil.rmtree(comic_path)
+        if os.path.isdir(comic_path) or os.path.isfile(comic_path + ARCHIVE_EXTENSION):
+            if os.path.isdir(comic_path): shutil.rmtree(comic_path)
+            if os.path.isfile(comic_path + ARCHIVE_EXTENSION): os.remove(comic_path + ARCHIVE_EXTENSION)
             logging.info(f"已删除漫画: {comic_folder}")
-            # 从元数据中也移除，如果存在的话
+            # 从元数据和索引中也移除，如果存在的话；同一 ID 还有其他目录时由重扫登记它，元数据保留
             comic_id_str = comic_folder.split('_')[0]
-            if comic_id_str in library_metadata:
-                del library_metadata[comic_id_str]
-                save_metadata()
+            remove_from_index(comic_id_str, comic_folder)
+            rescan_library_index()
+            with library_index_lock:
+                remaining = library_index.get(comic_id_str)
+            if not remaining and comic_id_str in library_metadata:
+                delete_comic_metadata(comic_id_str)
+            # 同一 ID 的另一个目录接替登记时，其他进程也要索引它
+            publish_library_change(comic_folder, *([remaining["folder"]] if remaining else []))
             return jsonify({"status": "success"})
         else:
             return jsonify({"status": "error", "message": "Folder not found"}), 404
@@ -990,12 +3770,8 @@ def delete_comic(comic_folder):
 @app.route('/api/favorite/<comic_id>', methods=['POST'])
 def toggle_favorite(comic_id):
     try:
-        if comic_id not in library_metadata:
-            library_metadata[comic_id] = {}
-
-        current_status = library_metadata[comic_id].get('favorite', False)
-        library_metadata[comic_id]['favorite'] = not current_status
-        save_metadata()
+        current_status = library_metadata.get(comic_id, {}).get('favorite', False)
+        set_comic_favorite(comic_id, not current_status)
         logging.info(f"漫画 {comic_id} 收藏状态更新为: {not current_status}")
         return jsonify({"status": "success", "is_favorite": not current_status})
     except Exception as e:
@@ -1004,34 +3780,370 @@ def toggle_favorite(comic_id):
 
 @app.route('/api/comic/<path:comic_folder>')
 def get_comic_pages(comic_folder):
-    download_path = app_config.get("download_path")
-    comic_path = os.path.join(download_path, comic_folder)
-    if not os.path.isdir(comic_path): return jsonify({"error": "Comic not found"}), 404
+    if not is_safe_folder_name(comic_folder):
+        return jsonify({"error": "Invalid folder name"}), 400
     try:
-        files = [f for f in os.listdir(comic_path) if f.lower().endswith(('.jpg', '.png', '.jpeg', '.webp'))]
-        files.sort(key=lambda x: int(os.path.splitext(x)[0]))
-        return jsonify({"pages": files})
+        entry = get_index_entry(comic_folder)
+        if not entry: return jsonify({"error": "Comic not found"}), 404
+        return jsonify({"pages": entry["pages"]})
     except Exception as e: return jsonify({"error": str(e)}), 500
 
+@app.route('/thumbs/<path:comic_folder>')
+def serve_thumbnail(comic_folder):
+    if not is_safe_folder_name(comic_folder):
+        return "Forbidden", 403
+    entry = get_index_entry(comic_folder)
+    if not entry or not entry["cover"]: return "Not Found", 404
+    thumb_path = get_thumbnail(entry, request.args.get('w', type=int))
+    cover_url = f"/comics/{quote(comic_folder)}/{quote(entry['cover'])}"
+    if not thumb_path:
+        return redirect(cover_url)
+    # 缩略图的地址不随封面变化，只缓存一天，之后用 ETag/Last-Modified 重新验证
+    try:
+        response = send_file(os.path.abspath(thumb_path), mimetype=THUMBNAIL_FORMATS[thumbnail_settings()[1]][2],
+                             conditional=True, etag=True, max_age=THUMBNAIL_MAX_AGE)
+    except FileNotFoundError:
+        # 刚好被缓存淘汰，这次直接返回原图
+        return redirect(cover_url)
+    response.cache_control.public = True
+    return response
+
+@app.route('/api/backfill_thumbnails', methods=['POST'])
+def trigger_backfill_thumbnails():
+    if Image is None:
+        return jsonify({"status": "error", "message": "未安装 Pillow，无法生成缩略图"}), 400
+    return submit_job_response("thumbnails", (), "补全缩略图", "缩略图补全任务已启动")
+
+# --- 图片文件服务 ---
+# 页面路径按漫画库索引解析和鉴权：只有索引中登记过的页面可以访问，请求时不再检查磁盘路径。
+# file_serving 配置决定由谁发送文件内容：
+#   "sendfile"         Flask 把打开的文件交给 WSGI 服务器的 wsgi.file_wrapper，gunicorn 等服务器
+#                      用 sendfile 系统调用由内核直接发送(开发服务器没有 file_wrapper，仍由 Python 读写)
+#   "x-accel-redirect" 只返回 X-Accel-Redirect 头，由前面的 nginx 从 internal location 发送，例如
+#                          location /internal-comics/ { internal; alias /data/comics/; }
+#   "x-sendfile"       只返回带绝对路径的 X-Sendfile 头，由 lighttpd 或 Apache mod_xsendfile 发送
+# 后两种模式下 ETag、304 和 Range 请求都由前端服务器处理。
+# CBZ 归档中的页面只是归档文件中的一段，前端服务器无法单独发送，总是由 Flask 读出后返回。
+
+def resolve_page(filename):
+    """把 "目录/页面" 解析为 (索引条目, 页面名)，不是索引中登记过的页面时返回 (None, None)"""
+    folder, _, page = filename.partition('/')
+    entry = get_index_entry(folder) if folder else None
+    if not entry or page not in entry["pages"]: return None, None
+    return entry, page
+
+def archive_page_response(entry, page):
+    """从归档中读出页面；ETag 由归档的 mtime 和页面名组成，304 和 Range 请求由 werkzeug 处理。
+    修复后重新打包会改变同一 URL 下的内容，ETag 随归档的 mtime 变化"""
+    archive_path = os.path.join(app_config.get("download_path"), comic_disk_name(entry))
+    try:
+        mtime_ns = os.stat(archive_path).st_mtime_ns
+        data = read_archive_member(archive_path, page)
+    except (FileNotFoundError, KeyError):
+        return None
+    except zipfile.BadZipFile as e:
+        logging.error(f"读取漫画归档 {archive_path} 中的 {page} 失败: {e}")
+        return None
+    response = Response(data, mimetype=mimetypes.guess_type(page)[0])
+    response.set_etag(f"{mtime_ns:x}-{page}")
+    response.last_modified = mtime_ns // 1_000_000_000
+    response.cache_control.max_age = PAGE_MAX_AGE
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(data))
+
 @app.route('/comics/<path:filename>')
 def serve_comic_files(filename):
-    download_path = app_config.get("download_path")
-    abs_path = os.path.abspath(os.path.join(download_path, filename))
-    if not abs_path.startswith(os.path.abspath(download_path)):
-        return "Forbidden", 403
+    entry, page = resolve_page(filename)
+    if not entry: return "Not Found", 404
+    abs_path = os.path.join(os.path.abspath(app_config.get("download_path")), entry["folder"], page)
+
+    mode = app_config.get("file_serving", "sendfile")
+    if entry["archive"]:
+        response = archive_page_response(entry, page)
+        if response is None: return "Not Found", 404
+    elif mode == "x-accel-redirect":
+        response = Response(mimetype=mimetypes.guess_type(abs_path)[0])
+        prefix = app_config.get("file_serving_internal_prefix", "/internal-comics/").rstrip('/')
+        # 用索引中解析出的目录名和页面名，不转发请求里的原始路径
+        response.headers['X-Accel-Redirect'] = f"{prefix}/{quote(entry['folder'] + '/' + page)}"
+        response.cache_control.max_age = PAGE_MAX_AGE
+    elif mode == "x-sendfile":
+        response = Response(mimetype=mimetypes.guess_type(abs_path)[0])
+        # 响应头只能是 latin-1，原样传递路径的文件系统字节，中文目录名也能被前端服务器打开
+        response.headers['X-Sendfile'] = os.fsencode(abs_path).decode('latin-1')
+        response.cache_control.max_age = PAGE_MAX_AGE
+    else:
+        # send_file 会生成强 ETag 和 Last-Modified，并处理 304 与 Range 请求
+        try:
+            response = send_file(abs_path, conditional=True, etag=True, max_age=PAGE_MAX_AGE)
+        except FileNotFoundError:
+            # 索引还没跟上磁盘的变化(页面刚被删除或打包)
+            return "Not Found", 404
+    response.cache_control.public = True
+    return response
 
-    return send_from_directory(download_path, filename)
+def collect_metrics():
+    """本进程的指标，每项是一个指标的 [HELP 行, TYPE 行, 样本行...]"""
+    return [metric.collect() for metric in metrics_registry]
 
-# --- 主程序入口 ---
-if __name__ == '__main__':
-    load_data()
+@app.route('/metrics')
+def metrics():
+    if control_store is None:
+        processes = [collect_metrics()]
+    else:
+        publish_metrics()
+        processes = control_store.read_metrics()
+    # 按指标合并各进程的样本，HELP 和 TYPE 只输出一次
+    families = {}
+    for collected in processes:
+        for family in collected:
+            families.setdefault(family[0], family[:2]).extend(family[2:])
+    lines = [line for family in families.values() for line in family]
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4; charset=utf-8")
+
+# --- 多进程部署 ---
+# 生产环境由多进程 WSGI 服务器(见 wsgi.py)运行，每个工作进程都加载一份数据并提供网页服务。
+# 各进程抢 DATA_DIR 下的锁文件，抢到的 leader 独自运行定时扫描和全部后台任务；
+# 其他进程把任务命令写入控制库交给 leader 执行，状态接口返回 leader 发布的状态快照，
+# 元数据和配置的变化由 sync_shared_state 在进程之间同步。单进程运行时本进程就是 leader。
+LEADER_RETRY_SECONDS = 5
+COMMAND_POLL_SECONDS = 0.25
+JOB_COMMAND_TIMEOUT = 5
+COMMAND_RETENTION_SECONDS = 3600
+METRICS_PUBLISH_SECONDS = 5
+METRICS_STALE_SECONDS = 30
+control_store = None
+leader_status = {"seq": None, "payload": None}
+worker_state = {"started": False}
+worker_state_lock = threading.Lock()
+
+class LeaderElection:
+    """用锁文件选出唯一的 leader 进程；进程退出时锁由操作系统释放，其他进程重试即可接管"""
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @property
+    def is_leader(self):
+        return self.file is not None
+
+    def try_acquire(self):
+        if self.file is not None: return True
+        f = open(self.path, 'a+')
+        f.seek(0)
+        try:
+            if fcntl is not None: fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else: msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+        except OSError:
+            f.close(); return False
+        f.truncate(); f.write(str(os.getpid())); f.flush()
+        self.file = f
+        return True
+
+leader_election = LeaderElection(LEADER_LOCK_FILE)
+
+def runs_jobs_locally():
+    """本进程是否自己运行任务；没有通过 start_worker 参与选举时(例如被其他程序导入)视为唯一进程"""
+    return leader_election.is_leader or control_store is None
+
+class ControlStore:
+    """进程间控制库：leader 发布的状态快照，以及其他进程提交、等待 leader 执行的任务命令"""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS status (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                seq INTEGER NOT NULL,
+                payload TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS commands (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                action TEXT NOT NULL,
+                params TEXT NOT NULL,
+                created REAL NOT NULL,
+                claimed INTEGER NOT NULL DEFAULT 0,
+                result TEXT
+            );
+            CREATE TABLE IF NOT EXISTS metrics (
+                pid INTEGER PRIMARY KEY,
+                updated REAL NOT NULL,
+                payload TEXT NOT NULL
+            );
+        """)
+
+    def publish_status(self, payload):
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO status (id, seq, payload) VALUES (1, 1, ?)
+                ON CONFLICT(id) DO UPDATE SET seq = seq + 1, payload = excluded.payload
+            """, (payload,))
+
+    def read_status(self):
+        """返回 (序号, 状态 JSON)，leader 还没发布过时返回 (None, None)"""
+        with self.lock:
+            row = self.conn.execute("SELECT seq, payload FROM status WHERE id = 1").fetchone()
+        return row or (None, None)
 
+    def publish_metrics(self, payload):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO metrics (pid, updated, payload) VALUES (?, ?, ?)",
+                              (os.getpid(), time.time(), payload))
+
+    def read_metrics(self):
+        """各进程最近发布的指标；超过 METRICS_STALE_SECONDS 没有更新的进程视为已退出并删除"""
+        with self.lock:
+            self.conn.execute("DELETE FROM metrics WHERE updated < ?", (time.time() - METRICS_STALE_SECONDS,))
+            rows = self.conn.execute("SELECT payload FROM metrics ORDER BY pid").fetchall()
+        return [json.loads(payload) for payload, in rows]
+
+    def submit(self, action, params):
+        with self.lock:
+            return self.conn.execute("INSERT INTO commands (action, params, created) VALUES (?, ?, ?)",
+                                     (action, json.dumps(params, ensure_ascii=False), time.time())).lastrowid
+
+    def claim(self):
+        """取出所有未执行的命令并标记为已领取，领取后提交方不能再撤回"""
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self.conn.execute("SELECT id, action, params FROM commands WHERE claimed = 0 ORDER BY id").fetchall()
+                self.conn.executemany("UPDATE commands SET claimed = 1 WHERE id = ?", [(row[0],) for row in rows])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK"); raise
+        return [(command_id, action, json.loads(params)) for command_id, action, params in rows]
+
+    def complete(self, command_id, body, status):
+        with self.lock:
+            self.conn.execute("UPDATE commands SET result = ? WHERE id = ?",
+                              (json.dumps([body, status], ensure_ascii=False), command_id))
+
+    def result(self, command_id):
+        with self.lock:
+            row = self.conn.execute("SELECT result FROM commands WHERE id = ?", (command_id,)).fetchone()
+        return tuple(json.loads(row[0])) if row and row[0] else None
+
+    def withdraw(self, command_id):
+        """撤回还没被 leader 领取的命令，返回是否撤回成功"""
+        with self.lock:
+            return self.conn.execute("DELETE FROM commands WHERE id = ? AND claimed = 0", (command_id,)).rowcount == 1
+
+    def prune(self):
+        with self.lock:
+            self.conn.execute("DELETE FROM commands WHERE claimed = 1 AND created < ?",
+                              (time.time() - COMMAND_RETENTION_SECONDS,))
+
+def forward_job_command(action, params):
+    """把任务命令交给 leader 执行并等待结果，返回 (响应内容, HTTP 状态码)"""
+    command_id = control_store.submit(action, params)
+    deadline = time.monotonic() + JOB_COMMAND_TIMEOUT
+    while time.monotonic() < deadline:
+        result = control_store.result(command_id)
+        if result: return result
+        time.sleep(COMMAND_POLL_SECONDS / 2)
+    if control_store.withdraw(command_id):
+        return {"status": "error", "message": "后台任务进程没有响应，命令未执行"}, 503
+    return {"status": "success", "message": "命令已交给后台任务进程，请稍后查看任务列表"}, 202
+
+def process_job_commands():
+    """leader 执行其他进程提交的任务命令"""
+    for command_id, action, params in control_store.claim():
+        try:
+            body, status = execute_job_command(action, params)
+        except Exception as e:
+            logging.error(f"执行任务命令 {action} 失败: {e}")
+            body, status = {"status": "error", "message": str(e)}, 500
+        control_store.complete(command_id, body, status)
+
+def publish_metrics():
+    control_store.publish_metrics(json.dumps(collect_metrics(), ensure_ascii=False))
+
+def refresh_leader_status():
+    """读取 leader 发布的状态，有变化时唤醒本进程的状态推送连接"""
+    seq, payload = control_store.read_status()
+    if seq != leader_status["seq"]:
+        leader_status["seq"], leader_status["payload"] = seq, json.loads(payload) if payload else None
+        status_notifier.notify()
+
+def status_publisher():
+    """leader 把状态快照写入控制库，与状态推送一样只在变化或心跳间隔到了时重新计算"""
+    version, last_payload = status_notifier.version, None
+    while True:
+        try:
+            payload = json.dumps(build_status(), ensure_ascii=False, sort_keys=True)
+            if payload != last_payload:
+                control_store.publish_status(payload)
+                last_payload = payload
+                time.sleep(SSE_MIN_INTERVAL)
+        except Exception as e:
+            logging.error(f"发布任务状态失败: {e}")
+        version = status_notifier.wait(version, SSE_HEARTBEAT_SECONDS)
+
+def start_leader_services():
+    """只在 leader 进程中运行：缩略图补全、定时扫描和状态发布"""
+    logging.info(f"进程 {os.getpid()} 负责运行定时任务和后台任务。")
+    if Image is not None:
+        job_scheduler.submit("thumbnails", backfill_thumbnails_task, name="补全缩略图")
     logging.info("启动后台定时下载任务...")
-    scheduler_thread = threading.Thread(target=scheduled_downloader, daemon=True)
-    scheduler_thread.start()
+    threading.Thread(target=scheduled_downloader, daemon=True).start()
+    threading.Thread(target=status_publisher, daemon=True).start()
+
+def coordinator():
+    """每个进程的协调线程：leader 执行命令；其他进程读取 leader 的状态，并定期尝试接管 leader 锁"""
+    last_attempt = time.monotonic()
+    last_prune = last_metrics = 0
+    while True:
+        try:
+            if not leader_election.is_leader and time.monotonic() - last_attempt >= LEADER_RETRY_SECONDS:
+                last_attempt = time.monotonic()
+                if leader_election.try_acquire():
+                    logging.warning("原 leader 进程已退出，由本进程接管后台任务。")
+                    start_leader_services()
+            if leader_election.is_leader:
+                process_job_commands()
+                if time.monotonic() - last_prune >= COMMAND_RETENTION_SECONDS:
+                    control_store.prune(); last_prune = time.monotonic()
+            else:
+                refresh_leader_status()
+            if time.monotonic() - last_metrics >= METRICS_PUBLISH_SECONDS:
+                publish_metrics(); last_metrics = time.monotonic()
+        except Exception as e:
+            logging.error(f"进程协调失败: {e}")
+        time.sleep(COMMAND_POLL_SECONDS)
+
+def start_worker():
+    """加载数据并启动本进程的后台线程，每个进程只执行一次"""
+    global control_store
+    with worker_state_lock:
+        if worker_state["started"]: return
+        worker_state["started"] = True
+        load_data()
+        is_leader = leader_election.try_acquire()
+        if not is_leader and isinstance(metadata_store, JsonMetadataStore):
+            # JSON 文件每次整体重写，多个进程同时写入时后写的会覆盖其他进程的修改
+            raise RuntimeError("metadata_backend 为 json 时只能运行一个进程，请改用 sqlite 或只启动一个工作进程")
+        control_store = ControlStore(CONTROL_DB_FILE)
+        metrics_worker_labels[:] = [("worker", str(os.getpid()))]
+        threading.Thread(target=library_watcher, daemon=True).start()
+        threading.Thread(target=shared_state_watcher, daemon=True).start()
+        if is_leader:
+            start_leader_services()
+        else:
+            logging.info(f"进程 {os.getpid()} 只提供网页服务，后台任务由 leader 进程运行。")
+        threading.Thread(target=coordinator, daemon=True).start()
+
+def create_app():
+    """生产环境入口：WSGI 服务器在每个工作进程中调用，返回 Flask 应用"""
+    start_worker()
+    return app
+
+# --- 主程序入口 ---
+if __name__ == '__main__':
+    start_worker()
 
     logging.info("启动本地网页服务器...")
     logging.info("请在浏览器中打开 http://127.0.0.1:5000 来访问您的漫画库。")
     app.run(host='0.0.0.0', port=5000, debug=False)
-
-
@@ -0,0 +1,13 @@
+"""生产环境入口：用多进程 WSGI 服务器运行漫画库，例如
+
+    gunicorn --workers 4 --threads 8 --bind 0.0.0.0:5000 wsgi:app
+
+每个工作进程导入本模块时各自加载数据；只有抢到 DATA_DIR/leader.lock 的进程运行定时扫描和后台任务，
+它退出后其他进程会自动接管。不要使用 --preload，否则锁和后台线程会留在 fork 之前的主进程里。
+状态推送 (/api/status_stream) 是长连接，每个连接占用一个线程，--threads 要留出余量。
+多进程运行需要 sqlite 元数据后端(默认)；metadata_backend 为 json 时只能用 --workers 1。
+/metrics 由任一进程返回全部进程的指标，样本带 worker 标签。
+"""
+from run_library import create_app
+
+app = create_app()